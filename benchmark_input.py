@@ -0,0 +1,130 @@
+import sys, time, os, glob, resource, multiprocessing
+
+sys.path.append('configuration')
+sys.path.append('input')
+sys.path.append('utils')
+
+from dataset_manager import *
+from pipeline_metrics import STAGES
+import synthetic_h5
+
+
+def h5_files(path):
+    # the data_*.h5 files of a dataset directory, as the configurations list them
+    return sorted(glob.glob(os.path.join(path, "data_*.h5")))
+
+
+def override_data_path(config_input, data_path):
+    # data_path: a directory of h5 files, or with train/ and val/ subdirectories, such as a synthetic fixture
+    train_path = os.path.join(data_path, "train")
+    val_path = os.path.join(data_path, "val")
+    if not os.path.isdir(train_path):
+        train_path = data_path
+    if not os.path.isdir(val_path):
+        val_path = train_path
+    config_input.train_db_path = h5_files(train_path)
+    config_input.val_db_path = h5_files(val_path)
+    if len(config_input.train_db_path) == 0:
+        raise ValueError("no data_*.h5 files in " + train_path)
+    # the cached splits are keyed by the file list, do not mix them with the real dataset
+    config_input.split_cache_path = None
+
+
+def write_fixture(config_input, data_path, num_train_files=8, num_val_files=2):
+    # a synthetic dataset with the image size and the target columns the config expects
+    resolution = (800, 600)
+    if not hasattr(config_input, "hack_resize_image"):
+        resolution = (config_input.image_size[1], config_input.image_size[0])
+    num_columns = 100 if len(config_input.variable_names) > 35 else 35
+    print("writing a synthetic dataset of %d files to %s" % (num_train_files + num_val_files, data_path))
+    synthetic_h5.write_dataset(os.path.join(data_path, "train"), num_train_files, resolution=resolution,
+                               num_columns=num_columns, num_processes=multiprocessing.cpu_count())
+    synthetic_h5.write_dataset(os.path.join(data_path, "val"), num_val_files, resolution=resolution,
+                               num_columns=num_columns, first_file=num_train_files,
+                               num_processes=multiprocessing.cpu_count())
+
+
+def peak_memory_mb():
+    # the peak resident memory of this process and of its terminated or waited for children, ru_maxrss is in KB
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    return own, children
+
+
+def run_in_process(dataset, num_batches):
+    # sample, read, decode, augment and stack the batches one after the other, in this process
+    dataset.seed_worker(0)
+    for i in range(num_batches):
+        generated_ids = dataset.sampler.next_batch_ids()
+        start = time.time()
+        sensors, io_ops, nbytes = dataset.read_images(generated_ids)
+        dataset.metrics.record("read", time.time() - start, len(generated_ids))
+        dataset.metrics.add("read_bytes", nbytes)
+        dataset.metrics.add("read_ops", io_ops)
+
+        batch = dataset.next_batch(sensors, generated_ids)
+        if not dataset._config.use_perception_stack:
+            dataset.prepare_batch(batch)
+
+
+def run_with_workers(dataset, num_batches):
+    # the readers and the decoders processes of the config, the batches are consumed as fast as they come
+    for i in range(num_batches):
+        batch, islot = dataset.get_decoded_batch(dataset.output_queue)
+        if not dataset._config.use_perception_stack:
+            dataset.prepare_batch(batch)
+        if islot is not None:
+            dataset._batch_slots.release(islot)
+
+
+def benchmark_input(experiment_name, num_batches, data_path=None, with_workers=False, warmup_batches=5):
+    """ Measures the throughput of the training input pipeline, without building the network nor a session """
+    conf_module = __import__(experiment_name)
+    config_input = conf_module.configInput()
+    if data_path is not None:
+        if not os.path.exists(data_path):
+            write_fixture(config_input, data_path)
+        override_data_path(config_input, data_path)
+    if config_input.use_perception_stack:
+        print("the perception stack is not run, the batches stop at the decoded and augmented cameras")
+
+    start = time.time()
+    dataset_manager = DatasetManager(config_input, None)
+    dataset = dataset_manager.train
+    print("loaded %d training frames in %.1fs" % (dataset._targets.shape[0], time.time() - start))
+
+    if with_workers:
+        dataset.start_multiple_decoders_augmenters()
+        dataset.start_disk_readers()
+        run = run_with_workers
+    else:
+        run = run_in_process
+
+    run(dataset, warmup_batches)
+    # the statistics start after the warmup, which opens the files and fills the queues
+    dataset.metrics.interval_summary()
+    start = time.time()
+    run(dataset, num_batches)
+    elapsed = time.time() - start
+    stages, counters, queues = dataset.metrics.interval_summary()
+
+    print("%d batches of %d samples in %.2fs: %.1f samples/s" % (num_batches, config_input.batch_size, elapsed,
+                                                                num_batches * config_input.batch_size / elapsed))
+    for stage in STAGES:
+        if stage in stages:
+            s = stages[stage]
+            # with workers, the stages run in parallel, the sum of their times exceeds the elapsed time
+            print("  %-8s %8.4fs per batch, p50<%.3fs p90<%.3fs, %5.1f%% of the elapsed time" %
+                  (stage, s["mean"], s["p50"], s["p90"], 100.0 * s["sum"] / elapsed))
+    if "read_ops_per_batch" in counters:
+        print("  read %.1f MB/s, %.1f h5 reads per batch" % (counters["read_bytes"] / 1e6,
+                                                              counters["read_ops_per_batch"]))
+    if with_workers:
+        print("  " + dataset.metrics.log_line({}, {}, queues))
+
+    if with_workers:
+        for child in multiprocessing.active_children():
+            child.terminate()
+            child.join()
+    own, children = peak_memory_mb()
+    print("peak memory: %.0f MB in this process, %.0f MB in the largest worker" % (own, children))
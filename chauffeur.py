@@ -47,6 +47,13 @@ if __name__ == '__main__':
     parser.add_argument('-lg', '--log', help="activate the log file", action="store_true")
     parser.add_argument('-db', '--debug', help="put the log file to screen", action="store_true")
 
+    # input benchmark related
+    parser.add_argument('-nb', '--num_batches', type=int, default=100, help='benchmark_input: the number of batches to time')
+    parser.add_argument('-dp', '--data_path', type=str, default=None,
+                        help='benchmark_input: a directory of data_*.h5 files (or with train/ and val/ in it) used instead of the config ones, a synthetic dataset is written there if it does not exist')
+    parser.add_argument('-wk', '--with_workers', action="store_true",
+                        help='benchmark_input: run the reader and decoder processes of the config, instead of a single process')
+
     args = parser.parse_args()
     know_args = parser.parse_known_args()
 
@@ -86,6 +93,14 @@ if __name__ == '__main__':
             from test_train import test_train
 
             test_train(args.gpu)
+        elif args.mode == 'extract_features':
+            from extract_features import extract_features
+
+            extract_features(args.experiment_name)
+        elif args.mode == 'benchmark_input':
+            from benchmark_input import benchmark_input
+
+            benchmark_input(args.experiment_name, args.num_batches, args.data_path, args.with_workers)
         else:
             raise ValueError()
 
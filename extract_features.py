@@ -0,0 +1,64 @@
+import sys, time, os
+
+sys.path.append('configuration')
+sys.path.append('input')
+sys.path.append('utils')
+
+from dataset_manager import *
+import feature_cache
+
+
+def extract_split(dataset, perception_interface, path, file_names):
+    # runs the perception stack over every frame of the dataset, in the order of the frame ids, batch_size at a time
+    num_frames = dataset._images.num_frames()
+    batch_size = dataset._batch_size
+    num_cameras = dataset._num_cameras()
+    f = None
+    start = time.time()
+    for first in range(0, num_frames, batch_size):
+        ids = np.arange(first, min(first + batch_size, num_frames), dtype=np.int32)
+        # the last batch is padded with its last frame, the perception stack takes full batches
+        padded = np.concatenate([ids, np.repeat(ids[-1:], batch_size - len(ids))])
+
+        sensors, _, _ = dataset.read_images(padded)
+        # the num_cameras*B concatenation of the cameras, without any augmentation
+        images, _, _ = dataset.next_batch(sensors, padded)
+        features = perception_interface._merge_logits_all_perception(perception_interface.compute(images))
+
+        # num_cameras*B*H*W*C -> B*num_cameras*H*W*C
+        features = np.reshape(features, (num_cameras, batch_size) + features.shape[1:])
+        features = np.swapaxes(features, 0, 1)[:len(ids)].astype(np.float16)
+        if f is None:
+            f = feature_cache.create(path, file_names, num_frames, features.shape[1:])
+        f["features"][first:first + len(ids)] = features
+
+        if (first // batch_size) % 100 == 0:
+            print("extracted %d of %d frames, %.1f frames/s" % (first + len(ids), num_frames,
+                                                               (first + len(ids)) / (time.time() - start)))
+    feature_cache.finish(f)
+
+
+def extract_features(experiment_name):
+    """ Writes the perception features of the training and validation frames of an experiment once, into the
+        perception_feature_cache of its config """
+    from train import create_perception_interface
+
+    conf_module = __import__(experiment_name)
+    config_input = conf_module.configInput()
+    if not config_input.use_perception_stack:
+        raise ValueError("the experiment does not use the perception stack")
+    output = config_input.perception_feature_cache
+
+    # the frames go through the same decoding as the training, but without any augmentation, and are not read
+    # back from a previous cache
+    config_input.augment = [None] * len(config_input.sensor_names)
+    config_input.perception_feature_cache = None
+    dataset_manager = DatasetManager(config_input, None)
+    perception_interface = create_perception_interface(config_input)
+
+    for split, dataset in [("train", dataset_manager.train), ("val", dataset_manager.validation)]:
+        path = feature_cache.store_path(output, split)
+        print("extracting the perception features of", split, "to", path)
+        extract_split(dataset, perception_interface, path, dataset_manager.frame_files[split])
+
+    perception_interface.destroy()
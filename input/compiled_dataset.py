@@ -0,0 +1,122 @@
+import os, sys, h5py, cv2
+import numpy as np
+from image_sources import ArrayImages
+
+# A compiled dataset is a directory holding, for a list of h5 files:
+#   <sensor_name>.npy: uint8 N*H*W*C array of the decoded (bgr, as cv2.imdecode) and resized images of that sensor
+#   <dataset_name>.npy: the concatenated target matrices, such as targets.npy
+#   files.txt: the h5 files it was compiled from
+# The arrays are memory mapped when loading, so that the images are read zero-copy from the page cache.
+
+
+def store_path(base, split):
+    # split is "train" or "val"
+    if base is None:
+        return None
+    return os.path.join(base, split)
+
+
+def _file_list_path(path):
+    return os.path.join(path, "files.txt")
+
+
+def matches(path, file_names):
+    # whether there is a compiled store at path, compiled from the same list of files
+    if path is None or not os.path.exists(_file_list_path(path)):
+        return False
+    with open(_file_list_path(path), "r") as f:
+        compiled = [line.strip() for line in f if line.strip() != ""]
+    return set(compiled) == set(file_names)
+
+
+def frame_order(file_names, path):
+    # the files in the order of the frame ids: a compiled store matching them holds the frames of the files sorted
+    # by name, while the h5 files are read in the order they are listed
+    if matches(path, file_names):
+        return sorted(file_names)
+    return list(file_names)
+
+
+def load(path, sensor_names, target_names):
+    # returns the same structure as DatasetManager.read_all_files, the images are memory mapped
+    images = ArrayImages([np.load(os.path.join(path, name + ".npy"), mmap_mode='r') for name in sensor_names])
+    targets_cat = []
+    for name in target_names:
+        targets_cat.append(np.load(os.path.join(path, name + ".npy"), mmap_mode='r'))
+    return images, targets_cat
+
+
+def decode(encoded, is_label, resize_hw=None, faster_aug=False):
+    # the same decoding as Dataset.next_batch, labels are resized with the nearest neighbour
+    image = cv2.imdecode(encoded, 1)
+    if resize_hw is not None:
+        height, width = resize_hw
+        if is_label:
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_NEAREST)
+        else:
+            image = cv2.resize(image, (width, height))
+    if faster_aug:
+        image = image[::2, ::2, :]
+    return image
+
+
+def compile_dataset(file_names, path, sensor_names, target_names, resize_hw=None, faster_aug=False):
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    # first pass: the files that can be read, and their number of rows
+    readable = []
+    for cword in sorted(file_names):
+        try:
+            with h5py.File(cword, "r") as dset:
+                nrows = dset[target_names[0]].shape[0]
+                for name in sensor_names + target_names:
+                    if dset[name].shape[0] != nrows:
+                        raise IOError("inconsistent number of rows in " + name)
+                readable.append((cword, nrows))
+        except (IOError, KeyError) as e:
+            print("failed to open", cword, e)
+    total = sum(nrows for _, nrows in readable)
+    print("compiling", len(readable), "files,", total, "frames into", path)
+
+    outputs = {}
+    start = 0
+    for ifile, (cword, nrows) in enumerate(readable):
+        with h5py.File(cword, "r") as dset:
+            for name in target_names:
+                value = dset[name][:]
+                if name not in outputs:
+                    outputs[name] = np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode='w+',
+                                                              dtype=value.dtype, shape=(total,) + value.shape[1:])
+                outputs[name][start:start + nrows] = value
+
+            for name in sensor_names:
+                is_label = name.lower().startswith("seg")
+                for irow in range(nrows):
+                    encoded = dset[name][irow]
+                    if len(encoded) == 0:
+                        image = None
+                    else:
+                        image = decode(encoded, is_label, resize_hw, faster_aug)
+
+                    if name not in outputs:
+                        if image is None:
+                            raise ValueError("the first image of " + name + " is empty")
+                        outputs[name] = np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode='w+',
+                                                                  dtype=np.uint8, shape=(total,) + image.shape)
+                    if image is None:
+                        # missing images, such as missing segmentation labels, are left to zeros
+                        continue
+                    outputs[name][start + irow] = image
+        start += nrows
+        if ifile % 100 == 0:
+            print("compiled", ifile, "of", len(readable), "files")
+
+    for name in outputs:
+        outputs[name].flush()
+    del outputs
+
+    # written last, so that an interrupted compilation is not picked up
+    with open(_file_list_path(path), "w") as f:
+        for cword in file_names:
+            f.write(cword + "\n")
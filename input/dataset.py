@@ -1,28 +1,37 @@
-import random, cv2, time, threading, sys, Queue
+import random, cv2, time, threading, sys, Queue, os, math, collections
 
 import numpy as np
 #from joblib import Parallel, delayed
-from multiprocessing import Process, Pool
+from multiprocessing import Process, Pool, Value
+from multiprocessing.pool import ThreadPool
 from multiprocessing import Queue as mQueue
 import tensorflow as tf
 from codification import *
-from codification import encode, check_distance
+from codification import encode, check_distance, encode_batch, check_distance_batch
 
-from scipy.ndimage.filters import gaussian_filter
-import copy
 sys.path.append('utils')
 import mapping_helper
 
 from common_util import split_camera_middle_batch, camera_middle_zoom_batch
+from shared_batches import SharedBatchSlots
+import samplers
+from pipeline_metrics import PipelineMetrics
+from perception_stage import TaggedPerceptionStage
+
+# the inputs that are rendered from the map, given the pose of the car, instead of read from a column of the targets
+MAP_INPUT_NAMES = ["mapping", "dis_to_road_border", "is_onroad", "is_onshoulder"]
 
 class Dataset(object):
-    def __init__(self, splited_keys, images, datasets, config_input, augmenter, perception_interface):
+    def __init__(self, splited_keys, images, datasets, config_input, augmenter, perception_interface,
+                 is_validation=False, feature_cache=None):
         # sample inputs
         # splited_keys: _splited_keys_train[i_labels_per_division][i_steering_bins_perc][a list of keys]
-        # images: [i_sensor][i_file_number] = (lastidx, lastidx + x.shape[0], x)
+        # images: an H5Images or ArrayImages, images.read(i_sensor, i_frame) is the (encoded) image
         # datasets: [i_target_name] = dim*batch matrix, where batch=#all_samples
         # config_input: configInputs
         # augmenter: config_input.augment
+        # is_validation: the validation dataset runs fewer decoders, at a lower priority
+        # feature_cache: an optional feature_cache.FeatureCache of the perception features of the frames
 
         # save the inputs
         self._splited_keys = splited_keys
@@ -32,9 +41,61 @@ class Dataset(object):
         self._augmenter = augmenter
 
         self._batch_size = config_input.batch_size
+        self._is_validation = is_validation
+
+        # merge the follow and the straights in targets, once for all the batches
+        k = self._config.variable_names.index('Control')
+        self._targets[(self._targets[:, k]).astype(np.int) == 5, k] = 2.0
+
+        self._column_plan = self._compile_column_plan()
+
+        # sampling_seed: makes the sampled frames reproducible, the validation stream uses the next seed
+        seed = None
+        if hasattr(self._config, "sampling_seed") and self._config.sampling_seed is not None:
+            seed = self._config.sampling_seed + (1 if is_validation else 0)
+        # see samplers.make_sampler for the sampling modes
+        self.sampler = samplers.make_sampler(splited_keys, self._batch_size, seed, images, self._config)
+
+        # the cached perception features replace the images and the perception stack, which is only possible
+        # when nothing is augmented before the perception stack
+        self._feature_cache = None
+        if feature_cache is not None:
+            if all(this == None for this in augmenter):
+                self._feature_cache = feature_cache
+            else:
+                print("the images are augmented before the perception stack, the feature cache is not used")
+
+        # the decoders stack the cameras and add the image noises, unless the perception stack has to see the
+        # cameras separately, in which case the feeder does it on the perception features
+        self._stack_in_workers = not self._config.use_perception_stack
+
+        # uint8_image_transport: the images are sent to the gpu as uint8, and normalized in the graph,
+        # which needs the decoders to produce the final images without any float noise
+        self._uint8_transport = hasattr(self._config, "uint8_image_transport") and self._config.uint8_image_transport
+        if self._uint8_transport:
+            if not self._stack_in_workers or hasattr(self._config, "add_gaussian_noise") or \
+                    hasattr(self._config, "add_random_region_noise"):
+                raise ValueError("uint8_image_transport does not support the perception stack and the image noises")
+            self._images_dtype = np.uint8
+        elif any(self._config.image_as_float):
+            self._images_dtype = np.float32
+        else:
+            self._images_dtype = np.uint8
+
+        # mixed_precision: the float images, or the perception features, are sent to the gpu as float16,
+        # the network computes in float16 anyway
+        self._float16_transport = hasattr(self._config, "mixed_precision") and self._config.mixed_precision and \
+            not self._uint8_transport
+        if self._float16_transport and self._stack_in_workers and self._images_dtype == np.float32:
+            self._images_dtype = np.float16
 
         # prepare all the placeholders: 3 sources: _queue_image_input, _queue_targets, _queue_inputs
-        self._queue_image_input = tf.placeholder(tf.float32, shape=[config_input.batch_size,
+        image_dtype = tf.float32
+        if self._uint8_transport:
+            image_dtype = tf.uint8
+        elif self._float16_transport:
+            image_dtype = tf.float16
+        self._queue_image_input = tf.placeholder(image_dtype, shape=[config_input.batch_size,
                                                                     config_input.feature_input_size[0],
                                                                     config_input.feature_input_size[1],
                                                                     config_input.feature_input_size[2]])
@@ -55,19 +116,52 @@ class Dataset(object):
                                                                         self._config.inputs_sizes[i]]))
             self._queue_shapes.append(self._queue_inputs[-1].shape)
 
-        self._queue = tf.FIFOQueue(capacity=config_input.queue_capacity,
-                                   dtypes=[tf.float32] + [tf.float32] * (len(self._config.targets_names) + len(self._config.inputs_names)),
-                                   shapes=self._queue_shapes)
-        self._enqueue_op = self._queue.enqueue([self._queue_image_input] + self._queue_targets + self._queue_inputs)
-        self._dequeue_op = self._queue.dequeue()
+        # input_backend: "feed_queue" feeds each batch into a FIFOQueue from a python thread (the default),
+        # "tf_data" pulls the batches with tf.data.Dataset.from_generator, and prefetches them to the gpu
+        # when prefetch_to_gpu is set, so that the host to device copies overlap with the training steps
+        self._input_backend = "feed_queue"
+        if hasattr(self._config, "input_backend"):
+            self._input_backend = self._config.input_backend
+
+        if self._input_backend == "feed_queue":
+            self._queue = tf.FIFOQueue(capacity=config_input.queue_capacity,
+                                       dtypes=[image_dtype] + [tf.float32] * (len(self._config.targets_names) + len(self._config.inputs_names)),
+                                       shapes=self._queue_shapes)
+            self._enqueue_op = self._queue.enqueue([self._queue_image_input] + self._queue_targets + self._queue_inputs)
+            self._dequeue_op = self._queue.dequeue()
+        elif self._input_backend == "tf_data":
+            self._dequeue_op = self._build_tf_data_pipeline()
+        else:
+            raise ValueError("unknown input_backend " + str(self._input_backend))
+
+        if self._uint8_transport:
+            self._dequeue_op = list(self._dequeue_op)
+            self._dequeue_op[0] = self._normalize_images_in_graph(self._dequeue_op[0])
 
         #self.parallel_workers = Parallel(n_jobs=8, backend="threading")
         self.input_queue = mQueue(5)
-        self.output_queue = mQueue(5)
+        self._output_queue_size = 5
+        self.output_queue = mQueue(self._output_queue_size)
 
-        self.perception_interface = perception_interface
+        # the latencies of the pipeline stages and the queue depths, shared with the readers and the decoders
+        self.metrics = PipelineMetrics()
+        self.metrics.add_queue("input", self.input_queue, 5)
+        self.metrics.add_queue("output", self.output_queue, self._output_queue_size)
 
-        if "mapping" in self._config.inputs_names:
+        self.perception_interface = perception_interface
+        # allocated in start_multiple_decoders_augmenters, when the config asks for shared_memory_batch_slots
+        self._batch_slots = None
+        # the number of decoding processes that take batches, shared with them, the others are parked. All the
+        # decoders are forked at startup, the autotuning only changes this count. Allocated with the decoders
+        self._active_decoders = None
+        # the step times of the consumer, used to autotune the number of decoders
+        self._step_times = collections.deque(maxlen=100)
+        # the image decoding threads are created lazily in each decoding process, since threads do not survive fork
+        self._decode_pool = None
+        self._decode_pool_pid = None
+        self._full_image_shapes = {}
+
+        if any(name in MAP_INPUT_NAMES for name in self._config.inputs_names):
             version = "v1"
             if hasattr(self._config, "mapping_version"):
                 version = self._config.mapping_version
@@ -76,98 +170,296 @@ class Dataset(object):
 
 
     def get_batch_tensor(self):
+        # a list of tensors: the images, then the targets, then the inputs
         return self._dequeue_op
 
-    def sample_positions_to_train(self, number_of_samples, splited_keys):
-        out_splited_keys = []
-        for sp in splited_keys:
-            if len(sp)>0:
-                out_splited_keys.append(sp)
+    def _normalize_images_in_graph(self, images):
+        # the uint8 images to float32, divided by 255 for the cameras with sensors_normalize
+        normalize = list(self._config.sensors_normalize)
+        if hasattr(self._config, "camera_middle_split") and self._config.camera_middle_split:
+            # the same order as split_camera_middle_batch: the other cameras, then the two halves of the middle one
+            imiddle = self._config.sensor_names.index('CameraMiddle')
+            normalize = normalize[:imiddle] + normalize[imiddle+1:] + [normalize[imiddle]] * 2
+        num_sensors = len(normalize)
+        scales = np.array([1.0 / 255.0 if x else 1.0 for x in normalize], dtype=np.float32)
+        if self._width_stack():
+            scales = np.reshape(np.repeat(scales, self._config.feature_input_size[1] // num_sensors), (1, 1, -1, 1))
+        else:
+            scales = np.reshape(np.tile(scales, self._config.feature_input_size[2] // num_sensors), (1, 1, 1, -1))
+        return tf.cast(images, tf.float32) * tf.constant(scales)
+
+    def _build_tf_data_pipeline(self):
+        dataset = tf.data.Dataset.from_generator(self._generate_batches,
+                                                 output_types=tuple([self._queue_image_input.dtype] +
+                                                                    [tf.float32] * (len(self._queue_shapes) - 1)),
+                                                 output_shapes=tuple(self._queue_shapes))
+        if hasattr(self._config, "prefetch_to_gpu") and self._config.prefetch_to_gpu:
+            dataset = dataset.apply(tf.contrib.data.prefetch_to_device('/gpu:0',
+                                                                       buffer_size=self._config.queue_capacity))
+        else:
+            dataset = dataset.prefetch(self._config.queue_capacity)
+        # initialized in start_all_threads, once the pipeline threads are running
+        self._iterator = dataset.make_initializable_iterator()
+        return list(self._iterator.get_next())
 
-        return np.random.choice(range(len(out_splited_keys)),
-                                size=number_of_samples,
-                                replace=True), \
-               out_splited_keys
+    def _generate_batches(self):
+        # runs in the tf.data runtime, pulls the batches from the end of the pipeline
+        while True:
+            if self._final_queue is self.output_queue:
+                one_batch, islot = self.get_decoded_batch(self._final_queue)
+            else:
+                one_batch, islot = self._final_queue.get(), None
+            start = time.time()
+            prepared = self.prepare_batch(one_batch)
+            dtypes = [self._queue_image_input.dtype.as_numpy_dtype] + [np.float32] * (len(prepared) - 1)
+            if islot is not None:
+                # copy out of the slot, since the slot is reused once released
+                out = tuple(np.array(x, dtype=dtype) for x, dtype in zip(prepared, dtypes))
+                self._batch_slots.release(islot)
+            else:
+                out = tuple(np.asarray(x, dtype=dtype) for x, dtype in zip(prepared, dtypes))
+            self.metrics.record("feed", time.time() - start, self._batch_size)
+            yield out
+
+    def _compile_column_plan(self):
+        # resolve the targets and inputs names into columns of self._targets and per column transforms,
+        # so that next_batch fills the targets and the scalar inputs with a few vectorized operations
+        variable_names = self._config.variable_names
+        plan = {}
+
+        # targets: value = clip(column * scale, lower, upper)
+        plan["target_columns"] = np.array([variable_names.index(name) for name in self._config.targets_names],
+                                          dtype=np.int64)
+        n = len(self._config.targets_names)
+        plan["target_scale"] = np.ones(n)
+        plan["target_lower"] = np.full(n, -np.inf)
+        plan["target_upper"] = np.full(n, np.inf)
+        for i, name in enumerate(self._config.targets_names):
+            if name == "Speed":
+                # Yang: speed_factor is normalizing the speed
+                plan["target_scale"][i] = 1.0 / (self._config.speed_factor / 3.6)
+            elif name == "Gas":
+                # Yang: require Gas >=0
+                plan["target_lower"][i] = 0.0
+            elif name == "Brake":
+                # Yang: require 0<=Brake<=1
+                plan["target_lower"][i] = 0.0
+                plan["target_upper"][i] = 1.0
+
+        # inputs: (column, name), the map inputs are rendered from the pose columns
+        plan["inputs"] = []
+        for name in self._config.inputs_names:
+            if name in MAP_INPUT_NAMES:
+                plan["inputs"].append((None, name))
+            elif name in ["Control", "Speed", "Distance"]:
+                plan["inputs"].append((variable_names.index(name), name))
+            else:
+                raise ValueError()
+
+        if any(name in MAP_INPUT_NAMES for name in self._config.inputs_names):
+            plan["pose"] = {name: variable_names.index(name)
+                            for name in ["Pos_X", "Pos_Y", "Ori_X", "Ori_Y", "Ori_Z", "town_id"]}
+
+        return plan
+
+    def map_poses(self, target_selected):
+        # the town ids, positions and orientations of the selected samples, in the format of mapping_helper.get_map
+        pose = self._column_plan["pose"]
+        town_ids = [str(int(town_id)).zfill(2) for town_id in target_selected[:, pose["town_id"]]]
+        positions = target_selected[:, [pose["Pos_X"], pose["Pos_Y"]]].tolist()
+        orientations = target_selected[:, [pose["Ori_X"], pose["Ori_Y"], pose["Ori_Z"]]].tolist()
+        return town_ids, positions, orientations
+
+    def add_map_pose_noise(self, town_ids, positions, orientations):
+        # the training time noise of the position and the yaw, returns new lists
+        std = self._config.map_pos_noise_std
+        fun_trunc_normal = lambda std: max(min(np.random.normal(scale=std), 2*std), -2*std)
+
+        out_positions = []
+        out_orientations = []
+        for town_id, pos, ori in zip(town_ids, positions, orientations):
+            pos = [pos[0] + fun_trunc_normal(std), pos[1] + fun_trunc_normal(std)]
+            ori = list(ori)
+            if town_id == "01" or town_id == "02":
+                # noise to the yaw
+                yaw = np.arctan2(-ori[1], ori[0]) + np.random.normal(scale=np.deg2rad(self._config.map_yaw_noise_std))
+                ori[0] = np.cos(yaw)
+                ori[1] = - np.sin(yaw)
+            elif town_id == "10" or town_id == "11" or town_id == "13":
+                ori[2] += np.rad2deg(np.random.normal(scale=np.deg2rad(self._config.map_yaw_noise_std)))
+            else:
+                raise ValueError()
+            out_positions.append(pos)
+            out_orientations.append(ori)
+        return out_positions, out_orientations
 
     # Used by next_batch, for each of the control block,
-    def datagen(self, batch_size, number_control_divisions):
-        # typical input: batch_size, number_control_divisions=3, since 3 blocks
+    def datagen(self):
         # Goal: uniformly select from different control signals (group), different steering percentiles.
-        generated_ids = np.zeros((batch_size, ), dtype='int32')
-
-        count = 0
-        to_be_decoded = [[] for _ in range(len(self._images))]
-        for control_part in range(0, number_control_divisions):
-            num_to_sample = int(batch_size // number_control_divisions)
-            if control_part == (number_control_divisions - 1):
-                num_to_sample = batch_size - (number_control_divisions - 1) * num_to_sample
-
-            sampled_positions, non_empty_split_keys = self.sample_positions_to_train(num_to_sample,
-                                                               self._splited_keys[control_part])
-
-            for outer_n in sampled_positions:
-                i = random.choice(non_empty_split_keys[outer_n])
-                for isensor in range(len(self._images)):
-                    # fetch the image from the h5 files
-                    per_h5_len = self._images[isensor][0].shape[0]
-                    ibatch = i // per_h5_len
-                    iinbatch = i % per_h5_len
-                    imencoded = self._images[isensor][ibatch][iinbatch]
-                    to_be_decoded[isensor].append(imencoded)
-
-                generated_ids[count] = i
-                count += 1
-
+        # the frame ids come from self.sampler, see samplers.BalancedSampler
+        generated_ids = self.sampler.next_batch_ids()
+        to_be_decoded, _, _ = self.read_images(generated_ids)
         return to_be_decoded, generated_ids
 
+    def read_images(self, generated_ids):
+        # returns the encoded images of the frames, for each sensor, and the number of h5 reads and bytes read
+        # read_merge_gap: frames of a file at most that many rows apart are read with a single h5 slice
+        max_gap = 16
+        if hasattr(self._config, "read_merge_gap"):
+            max_gap = self._config.read_merge_gap
+
+        if self._feature_cache is not None:
+            features, io_ops = self._feature_cache.read_batch(generated_ids)
+            return features, io_ops, features.nbytes
+
+        to_be_decoded = []
+        io_ops = 0
+        nbytes = 0
+        for isensor in range(len(self._images)):
+            # fetch the images from the h5 files
+            images, ops = self._images.read_batch(isensor, generated_ids, max_gap)
+            to_be_decoded.append(images)
+            io_ops += ops
+            nbytes += sum(x.nbytes for x in images)
+
+        return to_be_decoded, io_ops, nbytes
+
     @staticmethod
-    def get_boundary(oldseg):
-        seg = copy.deepcopy(oldseg)
-        seg[seg == 2] = 8
-        ind7 = (seg == 7)
-        hyp1 = np.logical_and(np.concatenate((seg[1:, :], np.zeros((1, seg.shape[1]))), axis=0) == 8, ind7)
-        hyp2 = np.logical_and(np.concatenate((np.zeros((1, seg.shape[1])), seg[:-1, :]), axis=0) == 8, ind7)
-        hyp3 = np.logical_and(np.concatenate((seg[:, 1:], np.zeros((seg.shape[0], 1))), axis=1) == 8, ind7)
-        hyp4 = np.logical_and(np.concatenate((np.zeros((seg.shape[0], 1)), seg[:, :-1]), axis=1) == 8, ind7)
-        lor = np.logical_or
-        final = lor(lor(lor(hyp1, hyp2), hyp3), hyp4)
-
-        e = gaussian_filter(final * 1.0, 10, mode='constant')
-        e = (e * 1000).astype(np.uint8)
-        e = (e > 0)
-
-        e = np.logical_or(e, oldseg == 2)
-        return e
+    def get_boundary_batch(segs, radius=27):
+        # segs: B*H*W segmentation labels. The boundary is the class 7 pixels 4-connected to a class 2 or 8 pixel,
+        # widened by radius pixels, plus all the class 2 pixels.
+        # The radius replaces the former gaussian_filter(sigma=10) > 0.001 test, that widens a boundary line by ~27 pixels
+        is2 = (segs == 2)
+        is8 = np.logical_or(segs == 8, is2)
+        near8 = np.zeros_like(is8)
+        near8[:, :-1, :] |= is8[:, 1:, :]
+        near8[:, 1:, :] |= is8[:, :-1, :]
+        near8[:, :, :-1] |= is8[:, :, 1:]
+        near8[:, :, 1:] |= is8[:, :, :-1]
+        final = np.logical_and(near8, segs == 7)
+
+        bound = is2
+        for ib in range(segs.shape[0]):
+            if not final[ib].any():
+                continue
+            # distance to the closest boundary pixel, which are the zeros of the input
+            dist = cv2.distanceTransform(np.logical_not(final[ib]).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+            bound[ib] |= (dist <= radius)
+        return bound
 
     @staticmethod
-    def augment_lane(camera, seg):
-        camera = copy.deepcopy(camera)
-        seg = copy.deepcopy(seg)
-        seg = seg[:, :, 0]
-        ind = (seg == 6)
-
-        xs, ys = np.where(ind)
-        ysp = np.minimum(ys + np.random.randint(-30, 30), camera.shape[1] - 1)
-        camera[xs, ys, :] = camera[xs, ysp, :]
-
-        bound = Dataset.get_boundary(seg)
-        xs, ys = np.where(bound)
+    def augment_lane_batch(cameras, segs, radius=27):
+        # cameras: B*H*W*C, modified in place; segs: B*H*W labels, the channel 0 of the decoded segmentation
+        B, H, W = segs.shape
+        # the lane markers are shifted horizontally, by a random offset per image
+        bs, xs, ys = np.nonzero(segs == 6)
+        shifts = np.random.randint(-30, 30, size=B)
+        ysp = np.minimum(np.maximum(ys + shifts[bs], 0), W - 1)
+        cameras[bs, xs, ys, :] = cameras[bs, xs, ysp, :]
+
+        # the road boundaries are shifted by a random offset per pixel
+        bs, xs, ys = np.nonzero(Dataset.get_boundary_batch(segs, radius))
         ysp = ys + np.random.randint(-40, 40, size=ys.shape)
-        ysp = np.minimum(camera.shape[1] - 1, np.maximum(0, ysp))
-        camera[xs, ys, :] = camera[xs, ysp, :]
+        ysp = np.minimum(W - 1, np.maximum(0, ysp))
+        cameras[bs, xs, ys, :] = cameras[bs, xs, ysp, :]
+
+        return cameras
+
+    def decode_segmentations(self, encoded):
+        # decode a list of segmentation labels, into a B*H*W array of the label channel
+        if np.ndim(encoded[0]) == 3:
+            # already decoded by utils/compile_dataset.py
+            return np.stack([x[:, :, 0] for x in encoded], 0)
+
+        func = lambda x: cv2.imdecode(x, 1)[:, :, 0]
+        pool = self._get_decode_pool()
+        if pool is not None:
+            results = pool.map(func, encoded)
+        else:
+            results = [func(x) for x in encoded]
+        return np.stack(results, 0)
+
+    def _get_decode_pool(self):
+        # decode_threads: the number of threads decoding the images of a batch, cv2 releases the GIL while decoding
+        if not hasattr(self._config, "decode_threads") or self._config.decode_threads <= 1:
+            return None
+        if self._decode_pool_pid != os.getpid():
+            self._decode_pool = ThreadPool(self._config.decode_threads)
+            self._decode_pool_pid = os.getpid()
+        return self._decode_pool
+
+    def _decode_plan(self, isensor, sample):
+        # returns the imdecode flag, the size to resize to and whether to drop every other pixel.
+        # With jpeg_scaled_decode, jpegs are decoded at 1/2, 1/4 or 1/8 of the resolution by libjpeg (DCT scaling),
+        # when the hack_resize_image or hack_faster_aug would throw away those pixels anyway
+        resize_hw = None
+        if hasattr(self._config, "hack_resize_image"):
+            resize_hw = self._config.hack_resize_image
+        faster_aug = hasattr(self._config, "hack_faster_aug")
+
+        factor = 1
+        is_jpeg = len(sample) > 2 and sample[0] == 0xFF and sample[1] == 0xD8
+        if hasattr(self._config, "jpeg_scaled_decode") and self._config.jpeg_scaled_decode and is_jpeg:
+            if isensor not in self._full_image_shapes:
+                self._full_image_shapes[isensor] = cv2.imdecode(sample, 1).shape
+            H, W = self._full_image_shapes[isensor][:2]
+            if resize_hw is not None:
+                for f in [8, 4, 2]:
+                    if (H + f - 1) // f >= resize_hw[0] and (W + f - 1) // f >= resize_hw[1]:
+                        factor = f
+                        break
+            elif faster_aug:
+                factor = 2
+
+        flag = {1: cv2.IMREAD_COLOR,
+                2: cv2.IMREAD_REDUCED_COLOR_2,
+                4: cv2.IMREAD_REDUCED_COLOR_4,
+                8: cv2.IMREAD_REDUCED_COLOR_8}[factor]
+        # a 1/2 scaled decode already has the shape of the [::2, ::2] subsampling
+        stride = faster_aug and not (resize_hw is None and factor == 2)
+        return flag, resize_hw, stride
+
+    @staticmethod
+    def _decode_one(x, flag, resize_hw, stride):
+        image = cv2.imdecode(x, flag)
+        if resize_hw is not None:
+            height, width = resize_hw
+            image = cv2.resize(image, (width, height))
+        if stride:
+            image = image[::2, ::2, :]
+        return image
+
+    def decode_images(self, encoded, isensor):
+        # decode a list of encoded images of the isensor-th sensor, into a B*H*W*C bgr array
+        if np.ndim(encoded[0]) == 3:
+            # already decoded and resized by utils/compile_dataset.py
+            return np.stack(encoded, 0)
+
+        flag, resize_hw, stride = self._decode_plan(isensor, encoded[0])
+        func = lambda x: Dataset._decode_one(x, flag, resize_hw, stride)
 
-        return camera
+        pool = self._get_decode_pool()
+        if pool is not None:
+            results = pool.map(func, encoded)
+        else:
+            results = [func(x) for x in encoded]
+        return np.stack(results, 0)
 
     """Return the next `batch_size` examples from this data set."""
 
     # Used by enqueue
-    def next_batch(self, sensors, generated_ids):
+    def next_batch(self, sensors, generated_ids, out=None):
         # generate unbiased samples;
         # apply augmentation on sensors and segmentation labels
         # normalize images
         # fill in targets and inputs. with reasonable valid condition checking
+        # out: optional flattened batch (see flatten_batch) to write the result into, such as a shared memory slot
+        if self._feature_cache is not None:
+            return self.cached_batch(sensors, generated_ids, out)
 
         batch_size = self._batch_size
+        start = time.time()
+        decode_seconds = 0.0
 
         if hasattr(self._config, "sensor_augments"):
             segmentations = sensors[len(sensors)//2 : ]
@@ -179,25 +471,17 @@ class Dataset(object):
         if self._augmenter[0] != None:
             aug_det = self._augmenter[0].to_deterministic()
 
+        resample_cameras = (hasattr(self._config, "camera_middle_split") and self._config.camera_middle_split) or \
+                           hasattr(self._config, "camera_middle_zoom")
+        # the splitting and zooming resize the float images, unless the images stay uint8 until the gpu
+        convert_early = resample_cameras and not self._uint8_transport
+
         # Get the images -- Perform Augmentation!!!
         for i in range(len(sensors)):
             # decode each of the sensor in parallel
-            func = lambda x: cv2.imdecode(x, 1)
-            if hasattr(self._config, "hack_resize_image"):
-                height, width = self._config.hack_resize_image
-                func_previous = func
-                func = lambda x: cv2.resize(func_previous(x), (width, height))
-
-            if hasattr(self._config, "hack_faster_aug"):
-                func_previous = func
-                func = lambda x: func_previous(x)[::2, ::2, :]
-
-            # func = delayed(func)
-            # results = self.parallel_workers(func(x) for x in to_be_decoded[isensor])
-            results = []
-            for x in sensors[i]:
-                results.append(func(x))
-            sensors[i] = np.stack(results, 0)
+            t0 = time.time()
+            sensors[i] = self.decode_images(sensors[i], i)
+            decode_seconds += time.time() - t0
 
             # from bgr to rgb
             sensors[i] = sensors[i][:, :, :, ::-1]
@@ -205,22 +489,23 @@ class Dataset(object):
             if self._augmenter[i] != None:
                 sensors[i] = aug_det.augment_images(sensors[i])
 
-            # TODO add augmentation for lane markers and road boundary
+            # augmentation for lane markers and road boundary, over all the selected samples at once
             if hasattr(self._config, "prob_augment_lane") and self._augmenter[i]!=None:
-                for ib in range(sensors[i].shape[0]):
-                    if aug_ind[ib]:
-                        if len(segmentations[i][ib]) > 0:
-                            decoded = cv2.imdecode(segmentations[i][ib], 1)
-                            sensors[i][ib, :, :, :] = self.augment_lane(sensors[i][ib, :,:,:], decoded)
-
-                            if np.random.rand() < 0.005:
-                                #cv2.imwrite("debug.png", sensors[i][ib, :,:,::-1])
-                                pass
-
-            if self._config.image_as_float[i]:
-                sensors[i] = sensors[i].astype(np.float32)
-            if self._config.sensors_normalize[i]:
-                sensors[i] /= 255.0
+                selected = [ib for ib in range(sensors[i].shape[0]) if aug_ind[ib] and len(segmentations[i][ib]) > 0]
+                if len(selected) > 0:
+                    t0 = time.time()
+                    segs = self.decode_segmentations([segmentations[i][ib] for ib in selected])
+                    decode_seconds += time.time() - t0
+                    radius = 27
+                    if hasattr(self._config, "lane_boundary_radius"):
+                        radius = self._config.lane_boundary_radius
+                    sensors[i][selected] = self.augment_lane_batch(sensors[i][selected], segs, radius)
+
+            if convert_early:
+                if self._config.image_as_float[i]:
+                    sensors[i] = sensors[i].astype(np.float32)
+                if self._config.sensors_normalize[i]:
+                    sensors[i] /= 255.0
 
         # TODO: perform image splitting here
         if hasattr(self._config, "camera_middle_split") and self._config.camera_middle_split:
@@ -246,167 +531,28 @@ class Dataset(object):
                 '''
 
 
-        # self._targets is the targets variables concatenated
-        # Get the targets
-
-        # merge the follow and the straights in targets
-        k = self._config.variable_names.index('Control')
-        self._targets[(self._targets[:, k]).astype(np.int) == 5, k] = 2.0
-        # end of the merging
+        targets, inputs = self.targets_and_inputs(generated_ids)
 
-        target_selected = self._targets[generated_ids, :]
-        target_selected = target_selected.T
+        # write the cameras into the network input, in its final layout, converting and normalizing in the same pass
+        if out is not None:
+            images = out[0]
+        else:
+            images = np.empty(self._images_shape(sensors[0].shape, len(sensors)), dtype=self._images_dtype)
+        views = self._camera_views(images, len(sensors))
+        for i in range(len(sensors)):
+            if convert_early or images.dtype == np.uint8 or not self._config.sensors_normalize[i]:
+                np.copyto(views[i], sensors[i], casting='unsafe')
+            else:
+                np.divide(sensors[i], np.float32(255.0), out=views[i], casting='unsafe')
 
-        # prepare the output targets, and inputs
-        targets = []
-        for i in range(len(self._config.targets_names)):
-            targets.append(np.zeros((batch_size, self._config.targets_sizes[i])))
-        inputs = []
-        for i in range(len(self._config.inputs_names)):
-            inputs.append(np.zeros((batch_size, self._config.inputs_sizes[i])))
-
-        for ibatch in range(0, batch_size):
-            for itarget in range(len(self._config.targets_names)):
-                # Yang: This is assuming that all target names has size 1
-                k = self._config.variable_names.index(self._config.targets_names[itarget])
-                targets[itarget][ibatch] = target_selected[k, ibatch]
-                this_name = self._config.targets_names[itarget]
-
-                if this_name == "Speed":
-                    # Yang: speed_factor is normalizing the speed
-                    targets[itarget][ibatch] /= self._config.speed_factor / 3.6
-                elif this_name == "Gas":
-                    # Yang: require Gas >=0
-                    targets[itarget][ibatch] = max(0, targets[itarget][ibatch])
-                elif this_name == "Brake":
-                    # Yang: require 0<=Brake<=1
-                    targets[itarget][ibatch] = min(1.0, max(0, targets[itarget][ibatch]))
-
-            for iinput in range(len(self._config.inputs_names)):
-                this_name = self._config.inputs_names[iinput]
-
-                if this_name == "mapping":
-                    # make the map
-                    pos_x = self._config.variable_names.index("Pos_X")
-                    pos_y = self._config.variable_names.index("Pos_Y")
-                    ori_x = self._config.variable_names.index("Ori_X")
-                    ori_y = self._config.variable_names.index("Ori_Y")
-                    ori_z = self._config.variable_names.index("Ori_Z")
-                    town_id = self._config.variable_names.index("town_id")
-
-                    pos = [target_selected[pos_x, ibatch], target_selected[pos_y, ibatch]]
-                    ori = [target_selected[ori_x, ibatch], target_selected[ori_y, ibatch], target_selected[ori_z, ibatch]]
-                    town_id = int(target_selected[town_id, ibatch])
-                    town_id =str(town_id).zfill(2)
-                    if self._augmenter[0]!=None:
-                        # we are in the training mode, thus we need to add some noise to the position
-                        std = self._config.map_pos_noise_std
-                        fun_trunc_normal = lambda std: max(min(np.random.normal(scale=std), 2*std), -2*std)
-                        pos = [pos[0] + fun_trunc_normal(std), pos[1] + fun_trunc_normal(std)]
-
-                        if town_id == "01" or town_id == "02":
-                            # noise to the yaw
-                            yaw = np.arctan2(-ori[1], ori[0]) + np.random.normal(scale=np.deg2rad(self._config.map_yaw_noise_std))
-                            ori[0] = np.cos(yaw)
-                            ori[1] = - np.sin(yaw)
-                        elif town_id == "10" or town_id == "11" or town_id == "13":
-                            ori[2] += np.rad2deg(np.random.normal(scale=np.deg2rad(self._config.map_yaw_noise_std)))
-                        else:
-                            raise ValueError()
-
-                    map = self.mapping_helper.get_map(town_id, pos, ori)
-                    # add a flattened operator, to make it compatible with the original format, remember to reshape it back
-                    inputs[iinput][ibatch] = map.flatten()
-
-                    if np.random.rand() < 0.005:
-                        # for debugging
-                        pass
-                        '''
-                        im = self.mapping_helper.map_to_debug_image(map)[:,:,::-1]
-                        center = sensors[1][ibatch, :,:,::-1]
-                        cv2.imwrite("debug_map.png", im)
-                        cv2.imwrite("debug_center_cam.png", center)
-                        '''
-                elif this_name == "dis_to_road_border":
-                    pos_x = self._config.variable_names.index("Pos_X")
-                    pos_y = self._config.variable_names.index("Pos_Y")
-                    ori_x = self._config.variable_names.index("Ori_X")
-                    ori_y = self._config.variable_names.index("Ori_Y")
-                    ori_z = self._config.variable_names.index("Ori_Z")
-                    town_id = self._config.variable_names.index("town_id")
-
-                    pos = [target_selected[pos_x, ibatch], target_selected[pos_y, ibatch]]
-                    ori = [target_selected[ori_x, ibatch], target_selected[ori_y, ibatch],
-                           target_selected[ori_z, ibatch]]
-                    town_id = int(target_selected[town_id, ibatch])
-                    town_id = str(town_id).zfill(2)
-                    map = self.mapping_helper.get_map(town_id, pos, ori)
-
-                    # add a flattened operator, to make it compatible with the original format, remember to reshape it back
-                    inputs[iinput][ibatch] = self.mapping_helper.compute_dis_to_border(map)
-                    #again
-                elif this_name == "is_onroad":
-                    pos_x = self._config.variable_names.index("Pos_X")
-                    pos_y = self._config.variable_names.index("Pos_Y")
-                    ori_x = self._config.variable_names.index("Ori_X")
-                    ori_y = self._config.variable_names.index("Ori_Y")
-                    ori_z = self._config.variable_names.index("Ori_Z")
-                    town_id = self._config.variable_names.index("town_id")
-
-                    pos = [target_selected[pos_x, ibatch], target_selected[pos_y, ibatch]]
-                    ori = [target_selected[ori_x, ibatch], target_selected[ori_y, ibatch],
-                           target_selected[ori_z, ibatch]]
-                    town_id = int(target_selected[town_id, ibatch])
-                    town_id = str(town_id).zfill(2)
-                    map = self.mapping_helper.get_map(town_id, pos, ori)
-
-                    # add a flattened operator, to make it compatible with the original format, remember to reshape it back
-                    inputs[iinput][ibatch] = self.mapping_helper.is_on_road(map)
-                    #again
-                elif this_name == "is_onshoulder":
-                    pos_x = self._config.variable_names.index("Pos_X")
-                    pos_y = self._config.variable_names.index("Pos_Y")
-                    ori_x = self._config.variable_names.index("Ori_X")
-                    ori_y = self._config.variable_names.index("Ori_Y")
-                    ori_z = self._config.variable_names.index("Ori_Z")
-                    town_id = self._config.variable_names.index("town_id")
-
-                    pos = [target_selected[pos_x, ibatch], target_selected[pos_y, ibatch]]
-                    ori = [target_selected[ori_x, ibatch], target_selected[ori_y, ibatch],
-                           target_selected[ori_z, ibatch]]
-                    town_id = int(target_selected[town_id, ibatch])
-                    town_id = str(town_id).zfill(2)
-                    map = self.mapping_helper.get_map(town_id, pos, ori)
-
-                    color = map[map.shape[0]*3//4, map.shape[1]//2, :]
-                    # TODO: it has to use map v2, not v3
-                    assert self.mapping_helper.version == "v2"
-                    if color[0] == 1 and color[1] == 0 and color[2] == 0:
-                        on_shoulder = 1
-                    else:
-                        on_shoulder = 0
-                    inputs[iinput][ibatch] = on_shoulder
-                else:
-                    k = self._config.variable_names.index(self._config.inputs_names[iinput])
-                    if this_name == "Control":
-                        inputs[iinput][ibatch] = encode(target_selected[k, ibatch])
-                    elif this_name == "Speed":
-                        inputs[iinput][ibatch] = target_selected[k, ibatch] / self._config.speed_factor * 3.6
-                    elif this_name == "Distance":
-                        inputs[iinput][ibatch] = check_distance(target_selected[k, ibatch])
-                    else:
-                        raise ValueError()
-
-        # change the output sensors variable
-        sensors = np.concatenate(sensors, axis=0)
         if self._augmenter[0] != None and hasattr(self._config, "sensor_dropout") and self._config.sensor_dropout > 0:
             # do the sensor dropout
-            # sensors[i] B H W C, after concat is 3B H W C
+            # in the order of the former 3B H W C concatenation of the cameras
             #print("augmenting the sensors dropout")
-            num_images = sensors.shape[0]
-            for i in range(num_images):
-                if np.random.rand() < self._config.sensor_dropout:
-                    sensors[i, :, :, :] = np.mean(sensors[i, :, :, :])
+            for view in views:
+                for ib in range(view.shape[0]):
+                    if np.random.rand() < self._config.sensor_dropout:
+                        view[ib] = np.mean(view[ib])
 
             if "mapping" in self._config.inputs_names:
                 #print("augmenting the mapping dropout")
@@ -415,8 +561,151 @@ class Dataset(object):
                     if np.random.rand() < self._config.mapping_dropout:
                         inputs[id][i, :] = np.mean(inputs[id][i])
 
+        if self._stack_in_workers:
+            self.add_image_noise(images)
+
+        self.metrics.record("decode", decode_seconds, batch_size)
+        self.metrics.record("augment", time.time() - start - decode_seconds, batch_size)
+
+        if out is not None:
+            for view, value in zip(out[1:], list(targets) + list(inputs)):
+                view[...] = value
+            return self.unflatten_batch(out)
+
+        return images, targets, inputs
+
+    def targets_and_inputs(self, generated_ids):
+        # the targets and the inputs of the frames, the inputs rendered from the map included
+        batch_size = self._batch_size
+
+        # self._targets is the targets variables concatenated
+        # Get the targets, the follow and the straights are already merged in __init__
+        plan = self._column_plan
+        target_selected = self._targets[generated_ids, :]
+
+        # prepare the output targets, and inputs
+        values = target_selected[:, plan["target_columns"]] * plan["target_scale"]
+        values = np.clip(values, plan["target_lower"], plan["target_upper"])
+        targets = []
+        for i in range(len(self._config.targets_names)):
+            # Yang: This is assuming that all target names has size 1
+            targets.append(np.repeat(values[:, i:i+1], self._config.targets_sizes[i], axis=1))
+
+        inputs = []
+        for i, (k, this_name) in enumerate(plan["inputs"]):
+            if this_name == "Control":
+                inputs.append(encode_batch(target_selected[:, k]))
+            elif this_name == "Speed":
+                inputs.append(target_selected[:, k:k+1] / self._config.speed_factor * 3.6)
+            elif this_name == "Distance":
+                inputs.append(check_distance_batch(target_selected[:, k:k+1]))
+            else:
+                inputs.append(np.zeros((batch_size, self._config.inputs_sizes[i])))
+
+            if inputs[-1].shape[1] != self._config.inputs_sizes[i]:
+                inputs[-1] = np.repeat(inputs[-1], self._config.inputs_sizes[i], axis=1)
+
+        map_inputs = [(iinput, this_name) for iinput, (_, this_name) in enumerate(plan["inputs"])
+                      if this_name in MAP_INPUT_NAMES]
+        if len(map_inputs) > 0:
+            town_ids, positions, orientations = self.map_poses(target_selected)
+
+        # the maps at the recorded pose are rendered once per sample, and shared by all the map inputs
+        maps_at_pose = None
+        for iinput, this_name in map_inputs:
+            if this_name == "mapping" and self._augmenter[0] != None:
+                # we are in the training mode, thus we need to add some noise to the position
+                noisy_positions, noisy_orientations = self.add_map_pose_noise(town_ids, positions, orientations)
+                maps = self.mapping_helper.get_maps_batch(town_ids, noisy_positions, noisy_orientations)
+            else:
+                if maps_at_pose is None:
+                    maps_at_pose = self.mapping_helper.get_maps_batch(town_ids, positions, orientations)
+                maps = maps_at_pose
+
+            if this_name == "mapping":
+                # add a flattened operator, to make it compatible with the original format, remember to reshape it back
+                inputs[iinput] = np.reshape(maps, (batch_size, -1)).astype(np.float64)
+
+                if np.random.rand() < 0.005:
+                    # for debugging
+                    pass
+                    '''
+                    im = self.mapping_helper.map_to_debug_image(maps[0])[:,:,::-1]
+                    center = sensors[1][0, :,:,::-1]
+                    cv2.imwrite("debug_map.png", im)
+                    cv2.imwrite("debug_center_cam.png", center)
+                    '''
+            else:
+                for ibatch in range(0, batch_size):
+                    map = maps[ibatch]
+                    if this_name == "dis_to_road_border":
+                        inputs[iinput][ibatch] = self.mapping_helper.compute_dis_to_border(map)
+                    elif this_name == "is_onroad":
+                        inputs[iinput][ibatch] = self.mapping_helper.is_on_road(map)
+                    elif this_name == "is_onshoulder":
+                        color = map[map.shape[0]*3//4, map.shape[1]//2, :]
+                        # TODO: it has to use map v2, not v3
+                        assert self.mapping_helper.version == "v2"
+                        if color[0] == 1 and color[1] == 0 and color[2] == 0:
+                            on_shoulder = 1
+                        else:
+                            on_shoulder = 0
+                        inputs[iinput][ibatch] = on_shoulder
+
+        return targets, inputs
+
+    def cached_batch(self, features, generated_ids, out=None):
+        # the next_batch of a feature cache, the features read by read_images are the output of the perception stack
+        start = time.time()
+        targets, inputs = self.targets_and_inputs(generated_ids)
+        self.metrics.record("augment", time.time() - start, self._batch_size)
+
+        if out is not None:
+            for view, value in zip(out, [features] + list(targets) + list(inputs)):
+                view[...] = value
+            return self.unflatten_batch(out)
+
+        return features, targets, inputs
+
+    def _num_cameras(self):
+        num_sensors = len(self._config.sensor_names)
+        if hasattr(self._config, "camera_middle_split") and self._config.camera_middle_split:
+            num_sensors += 1
+        return num_sensors
+
+    def _width_stack(self):
+        return (not hasattr(self._config, "camera_combine")) or self._config.camera_combine == "width_stack"
+
+    def _images_shape(self, camera_shape, num_sensors):
+        # the shape of the batch of images, given the B H W C shape of one camera
+        nB, nH, nW, nC = camera_shape
+        if not self._stack_in_workers:
+            # concatenated, for the perception stack
+            return (num_sensors * nB, nH, nW, nC)
+        elif self._width_stack():
+            return (nB, nH, num_sensors * nW, nC)
+        else:
+            return (nB, nH, nW, nC * num_sensors)
+
+    def _camera_views(self, images, num_sensors):
+        # the B H W C view of each camera into the batch of images, see stack_cameras for the layouts
+        if not self._stack_in_workers:
+            nB = images.shape[0] // num_sensors
+            return [images[i*nB:(i+1)*nB] for i in range(num_sensors)]
+        elif self._width_stack():
+            nW = images.shape[2] // num_sensors
+            return [images[:, :, i*nW:(i+1)*nW, :] for i in range(num_sensors)]
+        else:
+            # the channels are interleaved, channel c of camera i is at c*num_sensors + i
+            return [images[:, :, :, i::num_sensors] for i in range(num_sensors)]
 
-        return sensors, targets, inputs
+    def flatten_batch(self, batch):
+        # (sensors, targets, inputs) -> [sensors] + targets + inputs
+        return [batch[0]] + list(batch[1]) + list(batch[2])
+
+    def unflatten_batch(self, flat):
+        num_targets = len(self._config.targets_names)
+        return flat[0], list(flat[1:1+num_targets]), list(flat[1+num_targets:])
 
     @staticmethod
     def random_region_old(H, W, size, diversity_prob):
@@ -485,52 +774,62 @@ class Dataset(object):
             nregions *= 2
         return image
 
-    def process_run(self, sess, data_loaded):
-        t00 = time.time()
-        reshaped = data_loaded[0]
-        nB, nH, nW, nC = reshaped.shape
-        num_sensors = len(self._config.sensor_names)
-        if hasattr(self._config, "camera_middle_split") and self._config.camera_middle_split:
-            num_sensors += 1
+    def stack_cameras(self, sensors):
+        # sensors: the num_sensors*B H W C concatenation of the cameras, returns the B H num_sensors*W C (width_stack,
+        # the default) or B H W C*num_sensors (channel_stack) input of the network
+        # Only used on the perception features, next_batch writes the cameras directly in these layouts
+        nB, nH, nW, nC = sensors.shape
+        num_sensors = self._num_cameras()
 
-        t0 = time.time()
-        reshaped = np.reshape(reshaped, (num_sensors, nB//num_sensors, nH, nW, nC))
-        if (not hasattr(self._config, "camera_combine")) or self._config.camera_combine == "width_stack":
+        reshaped = np.reshape(sensors, (num_sensors, nB//num_sensors, nH, nW, nC))
+        if self._width_stack():
             reshaped = np.transpose(reshaped, (1, 2, 0, 3, 4))
             # now has shape nB//num_sensors, nH, num_sensors, nW, nC
             reshaped = np.reshape(reshaped, (nB//num_sensors, nH, num_sensors*nW, nC))
-            print("width stack")
-            #print("width stack cost ", time.time() - t0)
         elif self._config.camera_combine == "channel_stack":
             reshaped = np.transpose(reshaped, (1, 2, 3, 4, 0))
             # now has shape nB//num_sensors, nH, nW, nC, num_sensors
             reshaped = np.reshape(reshaped, (nB // num_sensors, nH, nW, nC * num_sensors))
-            #print("channel stack")
-            #print("shape of channel stack", reshaped.shape)
-            # print("channel stack total cost ", time.time() - t0)
+        return reshaped
 
+    def add_image_noise(self, images):
+        # adds the gaussian and the random region noises to the stacked B H W C images, in place and in their
+        # own dtype (float32), without full batch float64 temporaries
+        if self._augmenter[0] == None:
+            return
 
-        if hasattr(self._config, "add_gaussian_noise") and self._augmenter[0]!=None:
+        if hasattr(self._config, "add_gaussian_noise"):
             std = self._config.add_gaussian_noise
-            print("!!!!!!!!!!!!!!!!!!adding gaussian noise", std)
-            reshaped += np.random.normal(0, std, reshaped.shape)
+            # the noise is drawn one image at a time
+            for image in images:
+                noise = np.random.standard_normal(image.shape).astype(images.dtype)
+                noise *= std
+                image += noise
 
-        t0 = time.time()
-        if hasattr(self._config, "add_random_region_noise") and self._augmenter[0] != None:
+        if hasattr(self._config, "add_random_region_noise"):
             std = self._config.add_random_region_noise
-            #print("!!!!!!!!!!!!!!!!!add random region noise", std)
-            mask = Dataset.batch_random_region(reshaped.shape[0], reshaped.shape[1], reshaped.shape[2])
-            mask = np.reshape(mask, (reshaped.shape[0], reshaped.shape[1], reshaped.shape[2], 1))
-            reshaped += np.random.normal(0, std, (reshaped.shape[0], 1, 1, reshaped.shape[3])) * mask
-            #print("random region noise total cost ", time.time() - t0)
-
-        queue_feed_dict = {self._queue_image_input: reshaped}  # images we already put by default
+            mask = Dataset.batch_random_region(images.shape[0], images.shape[1], images.shape[2])
+            # one noise value per image and channel, added where the mask is set
+            noise = np.random.normal(0, std, (images.shape[0], 1, 1, images.shape[3])).astype(images.dtype)
+            np.add(images, noise, out=images, where=mask[:, :, :, np.newaxis])
+
+    def prepare_batch(self, data_loaded):
+        # returns [images] + targets + inputs, stacking the cameras and adding the image noises if the decoders
+        # have not already done it
+        reshaped = data_loaded[0]
+        if not self._stack_in_workers:
+            reshaped = self.stack_cameras(reshaped)
+            self.add_image_noise(reshaped)
+            if self._float16_transport and reshaped.dtype != np.float16:
+                reshaped = reshaped.astype(np.float16)
 
-        for i in range(len(self._config.targets_names)):
-            queue_feed_dict.update({self._queue_targets[i]: data_loaded[1][i]})
+        return [reshaped] + list(data_loaded[1]) + list(data_loaded[2])
 
-        for i in range(len(self._config.inputs_names)):
-            queue_feed_dict.update({self._queue_inputs[i]: data_loaded[2][i]})
+    def process_run(self, sess, data_loaded):
+        t00 = time.time()
+        prepared = self.prepare_batch(data_loaded)
+        queue_placeholders = [self._queue_image_input] + self._queue_targets + self._queue_inputs
+        queue_feed_dict = dict(zip(queue_placeholders, prepared))  # images we already put by default
 
         t0 = time.time()
         sess.run(self._enqueue_op, feed_dict=queue_feed_dict)
@@ -538,89 +837,277 @@ class Dataset(object):
 
         #print("total in process run cost ", time.time() - t00)
 
-    # Used by enqueue
+    # Used by add_image_noise
     @staticmethod
     def batch_random_region(B, H, W):
-        ans = []
-        for i in range(B):
-            size = np.random.randint(H*W//8, H*W//3)
-            ans.append(Dataset.random_region(H, W, size, 0.05))
-        return np.stack(ans, axis=0)
+        # the masks of random_region, for the whole batch at once: the rectangles of all the images are
+        # rasterized together, by adding +1/-1 at their corners and integrating along both axes
+        corners = np.zeros((B, H + 1, W + 1), dtype=np.float32)
+        # from 1/3 expectation 2 to minimum 3 in shape, each time
+        sizeW = W // 3
+        nregions = 1.5
+        while sizeW >= 3:
+            sizeH = int(sizeW * 1.0 / W * H)
+            counts = np.random.poisson(nregions, size=B)
+            ib = np.repeat(np.arange(B), counts)
+            n = ib.shape[0]
+
+            this_w = sizeW + np.random.normal(0, sizeW // 4, size=n).astype(np.int64)
+            this_h = sizeH + np.random.normal(0, sizeH // 4, size=n).astype(np.int64)
+            top = (np.random.rand(n) * np.maximum(H - this_h, 1)).astype(np.int64)
+            left = (np.random.rand(n) * np.maximum(W - this_w, 1)).astype(np.int64)
+            bottom = np.minimum(top + this_h, H)
+            right = np.minimum(left + this_w, W)
+
+            # rectangles with a negative jittered size are empty, as the slices of random_region
+            keep = np.logical_and(bottom > top, right > left)
+            ib, top, left, bottom, right = ib[keep], top[keep], left[keep], bottom[keep], right[keep]
+            np.add.at(corners, (ib, top, left), 1)
+            np.add.at(corners, (ib, top, right), -1)
+            np.add.at(corners, (ib, bottom, left), -1)
+            np.add.at(corners, (ib, bottom, right), 1)
+
+            sizeW = sizeW // 2
+            nregions *= 2
+
+        # each rectangle adds as many +1 as -1 to every column, so the running sum is back to 0 at the end of each
+        # image, and the batch can be integrated as a single tall image
+        covered = cv2.integral(np.reshape(corners, (B * (H + 1), W + 1)), sdepth=cv2.CV_32F)
+        covered = np.reshape(covered[1:, 1:], (B, H + 1, W + 1))
+        return covered[:, :H, :W] > 0.5
 
     def __getstate__(self):
         """Return state values to be pickled."""
         print("pickling")
-        return (self._splited_keys, self._targets, self._config, self._augmenter, self._batch_size)
+        return (self._splited_keys, self._targets, self._config, self._augmenter, self._batch_size, self._column_plan)
 
     def __setstate__(self, state):
         """Restore state from the unpickled state values."""
         print("unpickling")
-        self._splited_keys, self._targets, self._config, self._augmenter, self._batch_size = state
+        self._splited_keys, self._targets, self._config, self._augmenter, self._batch_size, self._column_plan = state
 
-    def _thread_disk_reader(self):
+    def _thread_sampler(self):
+        # the frame ids are drawn in this process, so that there is a single sampling stream whatever the
+        # number of readers
         while True:
-            #start = time.time()
-            sensors, generated_ids = self.datagen(self._batch_size, len(self._splited_keys))
-            self.input_queue.put((sensors, generated_ids))
-            #print('putting ele into input queue, cost', time.time()-start)
+            self.ids_queue.put(self.sampler.next_batch_ids())
 
     @staticmethod
-    def _thread_decode_augment(dataset, input_queue, output_queue):
+    def _thread_disk_reader(dataset, ids_queue, input_queue):
         while True:
+            generated_ids = ids_queue.get()
+            start = time.time()
+            sensors, io_ops, nbytes = dataset.read_images(generated_ids)
+            dataset.metrics.record("read", time.time() - start, len(generated_ids))
+            dataset.metrics.add("read_bytes", nbytes)
+            dataset.metrics.add("read_ops", io_ops)
+            input_queue.put((sensors, generated_ids))
+
+    def start_disk_readers(self):
+        # num_disk_readers: the number of reader processes. h5py serializes all the hdf5 calls of a process,
+        # so the readers are processes, each with its own h5 handles (see image_sources.H5FilePool).
+        # With a single reader, it is a thread of this process, as before.
+        n_readers = 1
+        if hasattr(self._config, "num_disk_readers") and not self._is_validation:
+            n_readers = self._config.num_disk_readers
+
+        self.ids_queue = mQueue(2 * n_readers)
+        self.metrics.add_queue("ids", self.ids_queue, 2 * n_readers)
+        t = threading.Thread(target=self._thread_sampler)
+        t.daemon = True
+        t.start()
+
+        for i in range(n_readers):
+            args = (self, self.ids_queue, self.input_queue)
+            if n_readers == 1:
+                p = threading.Thread(target=self._thread_disk_reader, args=args)
+                p.daemon = True
+            else:
+                p = Process(target=self._thread_disk_reader, args=args)
+            p.start()
+
+    @staticmethod
+    def _thread_decode_augment(dataset, input_queue, output_queue, niceness, worker_id, active_decoders):
+        if niceness > 0:
+            os.nice(niceness)
+        dataset.seed_worker(worker_id)
+        while True:
+            if worker_id >= active_decoders.value:
+                # parked by the autotuning
+                time.sleep(0.5)
+                continue
             sensors, generated_ids = input_queue.get()
-            out = dataset.next_batch(sensors, generated_ids)
+            # next_batch records the decode and augment times
+            if dataset._batch_slots is not None:
+                # write the batch in place into a shared memory slot, and only send the slot index
+                islot = dataset._batch_slots.acquire()
+                dataset.next_batch(sensors, generated_ids, out=dataset._batch_slots.views(islot))
+                out = islot
+            else:
+                out = dataset.next_batch(sensors, generated_ids)
             output_queue.put(out)
 
+    def allocate_batch_slots(self, num_slots):
+        # decode one batch in this process to know the layout of the batches, then allocate the slots
+        # the probe batch does not count in the sampling stream
+        sampler_state = self.sampler.get_state()
+        sensors, generated_ids = self.datagen()
+        self.sampler.set_state(sampler_state)
+        template = self.flatten_batch(self.next_batch(sensors, generated_ids))
+        self._batch_slots = SharedBatchSlots(template, num_slots)
+        print("allocated %d shared memory batch slots, %.1f MB" % (num_slots, self._batch_slots.nbytes() / 1e6))
+
+    def get_decoded_batch(self, output_queue):
+        # returns (batch, islot); islot is not None when the batch is a view into a shared memory slot,
+        # and the caller has to release the slot once it is done with the batch
+        one_batch = output_queue.get()
+        if self._batch_slots is not None:
+            return self.unflatten_batch(self._batch_slots.views(one_batch)), one_batch
+        return one_batch, None
+
     def start_multiple_decoders_augmenters(self):
+        if hasattr(self._config, "shared_memory_batch_slots") and self._config.shared_memory_batch_slots > 0:
+            # must happen before forking the workers, so that they share the slots
+            self.allocate_batch_slots(self._config.shared_memory_batch_slots)
+
         n_jobs = 6
-        for i in range(n_jobs):
-            p = Process(target=self._thread_decode_augment, args=(self, self.input_queue, self.output_queue))
+        if hasattr(self._config, "num_decoders"):
+            n_jobs = self._config.num_decoders
+        if self._is_validation:
+            # the validation only needs number_images_val samples every validation_period steps
+            if hasattr(self._config, "num_decoders_val"):
+                n_jobs = self._config.num_decoders_val
+            else:
+                n_jobs = max(1, n_jobs // 3)
+
+        autotune = hasattr(self._config, "autotune_decoders") and not self._is_validation
+        n_forked = n_jobs
+        if autotune:
+            # autotune_decoders = (min number of decoders, max number of decoders)
+            min_decoders, max_decoders = self._config.autotune_decoders
+            n_forked = max(n_jobs, max_decoders)
+
+        # forking once the session and the threads of this process exist is not safe, so the decoders the
+        # autotuning may need are all forked here, the first n_jobs take batches
+        self._active_decoders = Value('i', n_jobs)
+        niceness = 10 if self._is_validation else 0
+        for i in range(n_forked):
+            p = Process(target=self._thread_decode_augment,
+                        args=(self, self.input_queue, self.output_queue, niceness, i, self._active_decoders))
             #p = threading.Thread(target=self._thread_decode_augment, args=(self, self.input_queue, self.output_queue))
             p.start()
 
-    def _thread_perception_splitting(self, input_queue):
-        while True:
-            one_batch = input_queue.get()
-            print("input queue qsize", input_queue.qsize())
-            self.output_remaining_queue.put(one_batch[1:])
-            self.output_image_queue.put(one_batch[0])
+        if autotune:
+            t = threading.Thread(target=self._thread_autotune_decoders, args=(min_decoders, max_decoders))
+            t.daemon = True
+            t.start()
 
-    def _thread_perception_concat(self, perception_output):
+    def seed_worker(self, worker_id):
+        # the forked decoders inherit the random state of the parent, give each of them its own augmentation stream
+        seed = samplers.worker_seed(self.sampler.seed, worker_id)
+        np.random.seed(seed)
+        random.seed(seed)
+        for augmenter in self._augmenter:
+            if augmenter != None and hasattr(augmenter, "reseed"):
+                augmenter.reseed(seed)
+
+    def report_step_time(self, seconds):
+        # the time of one training step, as returned by TrainManager.run_train_step
+        self._step_times.append(seconds)
+        self.metrics.record("gpu_step", seconds, self._batch_size)
+
+    def _thread_autotune_decoders(self, min_decoders, max_decoders, period=30):
+        last_seconds, last_count = 0.0, 0
+        while True:
+            qsizes = []
+            for _ in range(period):
+                time.sleep(1.0)
+                qsizes.append(self.output_queue.qsize())
+
+            # the time spent in next_batch, summed over the decoders
+            count, decode_seconds = self.metrics.totals("decode")
+            _, augment_seconds = self.metrics.totals("augment")
+            seconds = decode_seconds + augment_seconds
+            if count == last_count:
+                continue
+            decode_time = (seconds - last_seconds) / (count - last_count)
+            last_seconds, last_count = seconds, count
+
+            current = self._active_decoders.value
+            wanted = current
+            if max(qsizes) == 0:
+                # the consumer was starved the whole period, its step times include the waiting
+                wanted = current + 1
+            elif len(self._step_times) > 0:
+                # each decoder delivers one batch per decode_time, the consumer takes one per step time
+                needed = int(math.ceil(decode_time / np.median(self._step_times) * 1.25))
+                if needed > current and min(qsizes) < self._output_queue_size - 1:
+                    wanted = current + 1
+                elif needed < current and min(qsizes) > 0:
+                    wanted = current - 1
+            wanted = min(max(wanted, min_decoders), max_decoders)
+
+            if wanted != current:
+                print("autotune decoders: %d -> %d, decode time %.3fs per batch, output queue %.1f" %
+                      (current, wanted, decode_time, np.mean(qsizes)))
+            # the decoders above the count park once done with their batch
+            self._active_decoders.value = wanted
+
+    def _thread_perception_dispatch(self, input_queue, stage):
         while True:
-            remain = self.output_remaining_queue.get()
-            image_feature = perception_output.get()
-            self.final_output_queue.put([image_feature, remain[0], remain[1]])
+            one_batch, islot = self.get_decoded_batch(input_queue)
+            if islot is not None:
+                # the perception stack keeps the images around, so copy them out of the slot
+                one_batch = (np.array(one_batch[0]), [np.array(x) for x in one_batch[1]],
+                             [np.array(x) for x in one_batch[2]])
+                self._batch_slots.release(islot)
+            # blocks while the perception stack has as many batches in flight as it can take
+            stage.put(one_batch[0], one_batch[1], one_batch[2])
 
     def _thread_feed_dict(self, sess, output_queue):
         while True:
-            #start = time.time()
-            one_batch = output_queue.get()
-            print("output qsize is", output_queue.qsize())
+            if output_queue is self.output_queue:
+                one_batch, islot = self.get_decoded_batch(output_queue)
+            else:
+                # the perception stack has already copied the batch out of its slot
+                one_batch, islot = output_queue.get(), None
+            start = time.time()
             self.process_run(sess, one_batch)
-            #print("fetched one output, cost ", time.time()-start)
+            self.metrics.record("feed", time.time() - start, self._batch_size)
+            if islot is not None:
+                self._batch_slots.release(islot)
 
     def start_all_threads(self, sess):
-        t = threading.Thread(target=self._thread_disk_reader)
-        t.isDaemon()
-        t.start()
-
+        # the decoders are forked before the reader threads start
         self.start_multiple_decoders_augmenters()
 
-        if self._config.use_perception_stack:
-            self.output_image_queue = Queue.Queue(5)
-            self.output_remaining_queue = Queue.Queue(5)
-            t = threading.Thread(target=self._thread_perception_splitting, args=(self.output_queue,))
-            t.start()
+        self.start_disk_readers()
 
-            perception_output = self.perception_interface.compute_async_thread_channel(self.output_image_queue)
+        if self._config.use_perception_stack and self._feature_cache is None:
+            # perception_lanes: the number of channels of the perception interface the batches are spread over,
+            # perception_lane_depth: the number of batches in flight in each of them
+            num_lanes = 1
+            if hasattr(self._config, "perception_lanes"):
+                num_lanes = self._config.perception_lanes
+            lane_depth = 5
+            if hasattr(self._config, "perception_lane_depth"):
+                lane_depth = self._config.perception_lane_depth
 
             self.final_output_queue = Queue.Queue(5)
-            t = threading.Thread(target=self._thread_perception_concat, args=(perception_output,))
+            self.metrics.add_queue("perception_output", self.final_output_queue, 5)
+            stage = TaggedPerceptionStage(self.perception_interface, num_lanes, lane_depth,
+                                          self.final_output_queue, self.metrics, self._batch_size)
+            t = threading.Thread(target=self._thread_perception_dispatch, args=(self.output_queue, stage))
             t.start()
             output_queue = self.final_output_queue
         else:
             output_queue = self.output_queue
 
-        t = threading.Thread(target=self._thread_feed_dict, args=(sess, output_queue))
-        t.isDaemon()
-        t.start()
+        if self._input_backend == "tf_data":
+            # the batches are pulled by the tf.data generator, instead of a feeding thread
+            self._final_queue = output_queue
+            sess.run(self._iterator.initializer)
+        else:
+            t = threading.Thread(target=self._thread_feed_dict, args=(sess, output_queue))
+            t.isDaemon()
+            t.start()
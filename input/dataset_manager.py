@@ -3,34 +3,40 @@ import tensorflow as tf
 
 sys.path.append('spliter')
 from dataset import *
+import compiled_dataset
+import feature_cache
+from image_sources import H5Images
+
+def partition_controls(controls, labels_per_division):
+    # the index of the division of each frame, -1 if the control is in none of them, these frames are dropped
+    # from the splits, where the original loop failed on them. As the original loop, a control listed in several
+    # divisions goes to the last one
+    controls = np.asarray(controls).astype(np.int64)
+    division = np.full(controls.shape[0], -1, dtype=np.int32)
+    for k in range(len(labels_per_division)):
+        division[np.isin(controls, labels_per_division[k])] = k
+    unassigned = np.count_nonzero(division < 0)
+    if unassigned > 0:
+        print(unassigned, "frames have a control in none of the divisions, they are dropped")
+    return division
+
 
 def split_bugfixed(controls, steers, labels_per_division, steering_bins_perc):
     # labels_per_division: [[0, 2, 5], [3], [4]]
     # steering_bins_perc: [0.05, 0.05, 0.1, 0.3, 0.3, 0.1, 0.05, 0.05]
-    initial_partition = [[] for _ in range(len(labels_per_division))]
-    for i in range(len(controls)):
-        index = None
-        for k in range(len(labels_per_division)):
-            if int(controls[i]) in labels_per_division[k]:
-                index = k
-        initial_partition[index].append(i)
+    division = partition_controls(controls, labels_per_division)
+    steers = np.asarray(steers)
+
+    # the binning boundaries, in percent
+    accumulated_percent = np.cumsum(steering_bins_perc[:-1]) * 100.0
 
     # then we continue to partition the steers
     output = []
-    steers = np.array(steers)
     for i_control_division in range(len(labels_per_division)):
         # get the steer values for this division
-        this_ids = initial_partition[i_control_division]
-        this_ids = np.array(this_ids)
+        this_ids = np.flatnonzero(division == i_control_division).astype(np.int32)
         this_steer = steers[this_ids]
 
-        # compute the binning boundaries
-        accumulated_percent = []
-        tot = 0.0
-        for percent in steering_bins_perc[:-1]:
-            tot += percent
-            accumulated_percent.append(tot * 100.0)
-
         boundaries = np.percentile(this_steer, accumulated_percent)
         digitized = np.digitize(this_steer, boundaries)
 
@@ -46,42 +52,41 @@ def split_bugfixed(controls, steers, labels_per_division, steering_bins_perc):
 def split_original(controls, steers, labels_per_division, steering_bins_perc):
     # labels_per_division: [[0, 2, 5], [3], [4]]
     # steering_bins_perc: [0.05, 0.05, 0.1, 0.3, 0.3, 0.1, 0.05, 0.05]
-    initial_partition = [[] for _ in range(len(labels_per_division))]
-    for i in range(len(controls)):
-        index = None
-        for k in range(len(labels_per_division)):
-            if int(controls[i]) in labels_per_division[k]:
-                index = k
-        if steers[i] < -0.99 or steers[i] > 0.99:
-            print("find one bad steer")
-        else:
-            initial_partition[index].append(i)
+    division = partition_controls(controls, labels_per_division)
+    steers = np.asarray(steers)
 
-    for i in range(len(initial_partition)):
-        print(len(initial_partition[i]), i, " length of the dataset, with index i ")
+    bad_steer = np.logical_or(steers < -0.99, steers > 0.99)
+    print("find", np.count_nonzero(bad_steer), "bad steers")
+    division[bad_steer] = -1
 
-    # then we continue to partition the steers
     output = []
-    for i in range(len(initial_partition)):
-        output.append([initial_partition[i]])
+    for i in range(len(labels_per_division)):
+        this_ids = np.flatnonzero(division == i).astype(np.int32)
+        print(len(this_ids), i, " length of the dataset, with index i ")
+        output.append([this_ids])
 
     return output
 
 split = split_original
 
 
-import glob, sys, os, inspect, cv2
+import glob, sys, os, inspect, cv2, hashlib
 
 def get_file_real_path():
     abspath = os.path.abspath(inspect.getfile(inspect.currentframe()))
     return os.path.realpath(abspath)
 
 class MapFilter():
+    # the map image is only read once per process
+    _map_cache = None
+
     def __init__(self):
-        path = os.path.dirname(get_file_real_path())
-        cil = os.path.dirname(path)
-        self.map = os.path.join(cil, "drive_interfaces/carla/comercial_cars/maps_demo_area/exptown_no_T_inter.png")
-        self.map = cv2.imread(self.map)
+        if MapFilter._map_cache is None:
+            path = os.path.dirname(get_file_real_path())
+            cil = os.path.dirname(path)
+            MapFilter._map_cache = cv2.imread(
+                os.path.join(cil, "drive_interfaces/carla/comercial_cars/maps_demo_area/exptown_no_T_inter.png"))
+        self.map = MapFilter._map_cache
 
     def loc_to_pix_exptown(self, loc):
         u = 6.848364717542121 * loc[1] + 1267.9073339940535
@@ -98,85 +103,153 @@ class MapFilter():
             else:
                 return True
 
+    def is_valid_batch(self, town_names, locx, locy):
+        # the vectorized is_valid, over arrays of frames
+        valid = np.asarray(town_names).astype(np.int64) == 11
+        locx = np.asarray(locx, dtype=np.float64)[valid]
+        locy = np.asarray(locy, dtype=np.float64)[valid]
+        # astype truncates towards zero, as int()
+        u = (6.848364717542121 * locy + 1267.9073339940535).astype(np.int64)
+        v = (-6.851075806443265 * locx + 2504.8267451634106).astype(np.int64)
+        valid[valid] = self.map[v, u, 0] == 0
+        return valid
+
 def filter_with_map(splited_keys, locx, locy, townid, images):
     output = []
     mf = MapFilter()
     for i in range(len(splited_keys)):
-        this = splited_keys[i][0]
-        tempout = []
-        for id in this:
-            validness = mf.is_valid(townid[id], locx[id], locy[id])
-            if validness:
-                tempout.append(id)
-
-            # for debug purpose
-            if np.random.rand()<0.001:
-                per_h5_len = images[1][0].shape[0]
-                ibatch = id // per_h5_len
-                iinbatch = id % per_h5_len
-                imencoded = images[1][ibatch][iinbatch]
-                if validness:
-                    name = "debug_valid_%d.png"
-                else:
-                    name = "debug_not_valid_%d.png"
-                with open(name % id, "wb") as f:
-                    f.write(imencoded)
-
-        output.append([tempout])
+        this = np.asarray(splited_keys[i][0], dtype=np.int32)
+        validness = mf.is_valid_batch(townid[this], locx[this], locy[this])
+
+        # for debug purpose
+        for j in np.flatnonzero(np.random.rand(len(this)) < 0.001):
+            id = this[j]
+            imencoded = images.read(1, id)
+            if validness[j]:
+                name = "debug_valid_%d.png"
+            else:
+                name = "debug_not_valid_%d.png"
+            with open(name % id, "wb") as f:
+                f.write(imencoded)
+
+        output.append([this[validness]])
     return output
 
 
+def split_cache_file(cache_path, file_names, num_frames, config):
+    # the splits only depend on the targets of the files, and on the config fields used below. The splits are
+    # frame ids, file_names is in the order of the frames, see compiled_dataset.frame_order
+    key = repr((list(file_names), num_frames, split.__name__,
+                config.labels_per_division, list(config.steering_bins_perc),
+                hasattr(config, "no_T_junction") and config.no_T_junction))
+    return os.path.join(cache_path, "splits_" + hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npz")
+
+
+def save_splited_keys(path, splited_keys):
+    arrays = {}
+    for i in range(len(splited_keys)):
+        for j in range(len(splited_keys[i])):
+            arrays["keys_%d_%d" % (i, j)] = np.asarray(splited_keys[i][j], dtype=np.int32)
+    # written to a temporary file first, so that an interrupted save is not picked up
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, **arrays)
+    os.rename(tmp, path)
+
+
+def load_splited_keys(path):
+    with np.load(path) as data:
+        shape = {}
+        for name in data.files:
+            i, j = [int(x) for x in name.split("_")[1:]]
+            shape[i] = max(shape.get(i, 0), j + 1)
+        return [[data["keys_%d_%d" % (i, j)] for j in range(shape[i])] for i in range(len(shape))]
+
+
 class DatasetManager(object):
     def __init__(self, config, perception_interface=None):
+        self._config = config
         # self._datasets_train is a list of totNum* dim, no transposed
         if hasattr(config, "sensor_augments"):
             all_names = config.sensor_names + config.sensor_augments
         else:
             all_names = config.sensor_names
 
+        # compiled_db_path: the decoded stores written by utils/compile_dataset.py, used instead of the h5 files
+        compiled_db_path = None
+        if hasattr(config, "compiled_db_path"):
+            compiled_db_path = config.compiled_db_path
+        # the files of each split, in the order of the frame ids
+        self.frame_files = {}
+        for name, file_names in [("train", config.train_db_path), ("val", config.val_db_path)]:
+            self.frame_files[name] = compiled_dataset.frame_order(file_names,
+                                                                  compiled_dataset.store_path(compiled_db_path, name))
+
         self._images_train, self._datasets_train = self.read_all_files(config.train_db_path,
                                                                        all_names,
-                                                                       config.dataset_names)
+                                                                       config.dataset_names,
+                                                                       compiled_dataset.store_path(compiled_db_path, "train"))
         self._images_val, self._datasets_val = self.read_all_files(config.val_db_path,
                                                                    all_names,
-                                                                   config.dataset_names)
+                                                                   config.dataset_names,
+                                                                   compiled_dataset.store_path(compiled_db_path, "val"))
 
         # self.labels_per_division = [[0, 2, 5], [3], [4]]
-        # The structure is: self._splited_keys_train[i_labels_per_division][i_steering_bins_perc][a list of keys]
+        # The structure is: self._splited_keys_train[i_labels_per_division][i_steering_bins_perc][an int32 array of keys]
         # This divide the keys into several smaller partition, simply by steering_bins_perc binning, order the same
-        splited_keys_train = split(controls=self._datasets_train[0][:, config.variable_names.index("Control")],
-                                   steers=self._datasets_train[0][:, config.variable_names.index("Steer")],
-                                   labels_per_division=config.labels_per_division,
-                                   steering_bins_perc=config.steering_bins_perc)
-
-        if hasattr(config, "no_T_junction") and config.no_T_junction:
-            splited_keys_train = filter_with_map(splited_keys_train,
-                                                 self._datasets_train[0][:, config.variable_names.index("Pos_X")],
-                                                 self._datasets_train[0][:, config.variable_names.index("Pos_Y")],
-                                                 self._datasets_train[0][:, config.variable_names.index("town_id")],
-                                                 self._images_train)
+        splited_keys_train = self.split_keys(self.frame_files["train"], self._datasets_train, self._images_train)
 
         self.train = Dataset(splited_keys_train,
                              self._images_train,
                              self._datasets_train, config, config.augment,
-                             perception_interface)
-
-        splited_keys_val = split(controls=self._datasets_val[0][:, config.variable_names.index("Control")],
-                                   steers=self._datasets_val[0][:, config.variable_names.index("Steer")],
-                                   labels_per_division=config.labels_per_division,
-                                   steering_bins_perc=config.steering_bins_perc)
+                             perception_interface,
+                             feature_cache=self.open_feature_cache("train", self._images_train))
 
-        if hasattr(config, "no_T_junction") and config.no_T_junction:
-            splited_keys_val = filter_with_map(splited_keys_val,
-                                                 self._datasets_val[0][:, config.variable_names.index("Pos_X")],
-                                                 self._datasets_val[0][:, config.variable_names.index("Pos_Y")],
-                                                 self._datasets_val[0][:, config.variable_names.index("town_id")],
-                                                 self._images_val)
+        splited_keys_val = self.split_keys(self.frame_files["val"], self._datasets_val, self._images_val)
 
         self.validation = Dataset(splited_keys_val,
                                   self._images_val,
                                   self._datasets_val, config, [None] * len(config.sensor_names),
-                                  perception_interface)
+                                  perception_interface, is_validation=True,
+                                  feature_cache=self.open_feature_cache("val", self._images_val))
+
+    def open_feature_cache(self, split, images):
+        # perception_feature_cache: the directory of the perception features written by extract_features.py
+        if not hasattr(self._config, "perception_feature_cache") or self._config.perception_feature_cache is None:
+            return None
+        path = feature_cache.store_path(self._config.perception_feature_cache, split)
+        if not feature_cache.matches(path, self.frame_files[split], images.num_frames()):
+            print("no feature cache matching the files at", path, ", running the perception stack")
+            return None
+        print("reading the perception features from", path)
+        return feature_cache.FeatureCache(path)
+
+    def split_keys(self, file_names, datasets, images):
+        config = self._config
+        # split_cache_path: a directory where the splits are cached, keyed by the file list and the split config
+        cache_file = None
+        if hasattr(config, "split_cache_path") and config.split_cache_path is not None:
+            if not os.path.exists(config.split_cache_path):
+                os.makedirs(config.split_cache_path)
+            cache_file = split_cache_file(config.split_cache_path, file_names, datasets[0].shape[0], config)
+            if os.path.exists(cache_file):
+                print("loading the cached splits", cache_file)
+                return load_splited_keys(cache_file)
+
+        splited_keys = split(controls=datasets[0][:, config.variable_names.index("Control")],
+                             steers=datasets[0][:, config.variable_names.index("Steer")],
+                             labels_per_division=config.labels_per_division,
+                             steering_bins_perc=config.steering_bins_perc)
+
+        if hasattr(config, "no_T_junction") and config.no_T_junction:
+            splited_keys = filter_with_map(splited_keys,
+                                           datasets[0][:, config.variable_names.index("Pos_X")],
+                                           datasets[0][:, config.variable_names.index("Pos_Y")],
+                                           datasets[0][:, config.variable_names.index("town_id")],
+                                           images)
+
+        if cache_file is not None:
+            save_splited_keys(cache_file, splited_keys)
+        return splited_keys
 
     def start_training_queueing(self, sess):
         self.train.start_all_threads(sess)
@@ -190,23 +263,36 @@ class DatasetManager(object):
         coord = tf.train.Coordinator()
         self._threads_val = tf.train.start_queue_runners(coord=coord, sess=sess)
 
-    def read_all_files(self, file_names, sensor_names, target_names):
-        sensor_cat = [list([]) for _ in range(len(sensor_names))]
+    def read_all_files(self, file_names, sensor_names, target_names, compiled_path=None):
+        if compiled_dataset.matches(compiled_path, file_names):
+            print("loading the compiled dataset", compiled_path)
+            return compiled_dataset.load(compiled_path, sensor_names, target_names)
+        elif compiled_path is not None:
+            print("no compiled dataset matching the files at", compiled_path, ", reading the h5 files")
+
+        max_open_files = 64
+        if hasattr(self._config, "max_open_h5_files"):
+            max_open_files = self._config.max_open_h5_files
+
         targets_cat = [list([]) for _ in range(len(target_names))]
+        readable = []
+        row_counts = []
 
         for cword in file_names:
             try:
-                dset = h5py.File(cword, "r")
-                for i in range(len(sensor_names)):
-                    x = dset[sensor_names[i]]
-                    sensor_cat[i].append(x)
+                # only read the number of rows and the targets here, the images are read lazily by H5Images
+                with h5py.File(cword, "r") as dset:
+                    this_targets = [dset[name][:] for name in target_names]
+                    nrows = this_targets[0].shape[0]
+                    for name in sensor_names:
+                        if dset[name].shape[0] < nrows:
+                            raise IOError("%s has %d rows, less than the %d targets" % (name, dset[name].shape[0], nrows))
 
                 for i in range(len(target_names)):
-                    dset_to_append = dset[target_names[i]]
                     # for the targets, we directly read them into memory
-                    targets_cat[i].append(dset_to_append[:])
-
-                dset.flush()
+                    targets_cat[i].append(this_targets[i])
+                readable.append(cword)
+                row_counts.append(nrows)
 
             except IOError:
                 import traceback
@@ -220,6 +306,6 @@ class DatasetManager(object):
         for i in range(len(target_names)):
             targets_cat[i] = np.concatenate(targets_cat[i], axis=0)
 
-        # sensor_cat is a list for each of the variables, each of them is a list of (start_index, end_index, x) tuples
+        # images is an H5Images, images.read(i_sensor, i_frame) returns the encoded image
         # targets_cat is a list for each of the variables, variable across batch are concatenated together with size totnum*dim
-        return sensor_cat, targets_cat
+        return H5Images(readable, sensor_names, row_counts, max_open_files), targets_cat
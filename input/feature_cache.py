@@ -0,0 +1,69 @@
+import os, h5py
+import numpy as np
+from image_sources import H5FilePool
+
+# A feature cache holds the merged perception logits (Perceptions._merge_logits_all_perception) of every frame of
+# a list of h5 files, computed once by extract_features.py, for the configs that run no augmentation before the
+# perception stack. There is one h5 file per split, such as train.h5, holding:
+#   features: float16 N*num_cameras*H*W*C, row i is the frame of id i of DatasetManager.read_all_files,
+#             compressed with one chunk per frame
+#   the attributes files, the h5 files it was extracted from in the order of the frame ids
+#   (compiled_dataset.frame_order), and complete, set once all the frames are written
+
+
+def store_path(base, split):
+    # split is "train" or "val"
+    if base is None:
+        return None
+    return os.path.join(base, split + ".h5")
+
+
+def matches(path, file_names, num_frames=None):
+    # whether there is a complete cache at path, extracted from the same files in the same order, since row i
+    # is frame id i, and with the number of frames when given
+    if path is None or not os.path.exists(path):
+        return False
+    with h5py.File(path, "r") as f:
+        if not f.attrs.get("complete", False):
+            return False
+        cached = [name for name in f.attrs["files"].split("\n") if name != ""]
+        return cached == list(file_names) and (num_frames is None or f["features"].shape[0] == num_frames)
+
+
+def create(path, file_names, num_frames, frame_shape):
+    # frame_shape: num_cameras*H*W*C, returns the open file, to be passed to finish
+    directory = os.path.dirname(path)
+    if directory != "" and not os.path.exists(directory):
+        os.makedirs(directory)
+    f = h5py.File(path, "w")
+    f.create_dataset("features", (num_frames,) + tuple(frame_shape), dtype=np.float16,
+                     chunks=(1,) + tuple(frame_shape), compression="lzf")
+    f.attrs["files"] = "\n".join(file_names)
+    f.attrs["complete"] = False
+    return f
+
+
+def finish(f):
+    # set last, so that an interrupted extraction is not picked up
+    f.attrs["complete"] = True
+    f.close()
+
+
+class FeatureCache(object):
+    # Reads the cached features of a batch of frames, in the layout the perception stack outputs them:
+    # the num_cameras*B concatenation of the cameras, camera major
+    def __init__(self, path):
+        self._pool = H5FilePool([path], max_open=1)
+        with h5py.File(path, "r") as f:
+            self.frame_shape = f["features"].shape[1:]
+
+    def read_batch(self, ids):
+        # returns the float16 features and the number of h5 reads
+        ids = np.asarray(ids)
+        # h5py wants increasing indices, without duplicates
+        unique, inverse = np.unique(ids, return_inverse=True)
+        with self._pool.reading(0) as handle:
+            features = handle["features"][unique.tolist()][inverse]
+        # B*num_cameras*H*W*C -> num_cameras*B*H*W*C
+        features = np.swapaxes(features, 0, 1)
+        return np.reshape(features, (-1,) + tuple(self.frame_shape[1:])), len(unique)
@@ -0,0 +1,128 @@
+import os, threading, collections, contextlib, h5py
+import numpy as np
+
+
+class H5FilePool(object):
+    # Opens the h5 files lazily, and keeps at most max_open of them open, closing the least recently used one.
+    # The handles are reference counted, so that a handle is only closed once no thread reads from it: the pool
+    # goes over max_open while all the open handles are in use, and shrinks back as they are released.
+    # The handles are never shared across processes: after a fork, or when unpickled, the files are reopened.
+    def __init__(self, file_names, max_open=64):
+        self._file_names = list(file_names)
+        self._max_open = max_open
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # ifile -> [handle, number of readers], in the order of use
+        self._handles = collections.OrderedDict()
+        self._pid = os.getpid()
+
+    @contextlib.contextmanager
+    def reading(self, ifile):
+        # the open handle of the ifile-th file, which stays open until the with block exits
+        with self._lock:
+            if self._pid != os.getpid():
+                # the handles belong to the parent process
+                self._reset()
+
+            if ifile in self._handles:
+                entry = self._handles.pop(ifile)
+            else:
+                entry = [h5py.File(self._file_names[ifile], "r"), 0]
+            entry[1] += 1
+            self._handles[ifile] = entry
+            self._close_unused()
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                self._close_unused()
+
+    def _close_unused(self):
+        # closes the least recently used handles without readers, down to max_open, called with the lock held
+        for ifile in list(self._handles.keys()):
+            if len(self._handles) <= self._max_open:
+                break
+            handle, readers = self._handles[ifile]
+            if readers == 0:
+                del self._handles[ifile]
+                handle.close()
+
+    def num_open(self):
+        return len(self._handles)
+
+    def __getstate__(self):
+        return (self._file_names, self._max_open)
+
+    def __setstate__(self, state):
+        self._file_names, self._max_open = state
+        self._lock = threading.Lock()
+        self._reset()
+
+
+class H5Images(object):
+    # The images of several sensors stored in a list of h5 files, indexed by the global frame id.
+    # The files can have different number of rows, the frame id is mapped to (file, row) by precomputed arrays.
+    def __init__(self, file_names, sensor_names, row_counts, max_open_files=64):
+        self._sensor_names = list(sensor_names)
+        self._pool = H5FilePool(file_names, max_open_files)
+        row_counts = np.array(row_counts, dtype=np.int64)
+        self.file_index = np.repeat(np.arange(len(row_counts)), row_counts).astype(np.int32)
+        self.row_index = (np.arange(self.file_index.shape[0]) -
+                          np.repeat(np.cumsum(row_counts) - row_counts, row_counts)).astype(np.int32)
+
+    def __len__(self):
+        # the number of sensors
+        return len(self._sensor_names)
+
+    def num_frames(self):
+        return self.file_index.shape[0]
+
+    def read(self, isensor, i):
+        # the encoded image of the isensor-th sensor, for the i-th frame
+        with self._pool.reading(self.file_index[i]) as handle:
+            return handle[self._sensor_names[isensor]][self.row_index[i]]
+
+    def read_batch(self, isensor, ids, max_gap=16):
+        # the encoded images of the isensor-th sensor for the frames ids, in the same order.
+        # Each run of frames of the same file, less than max_gap rows apart, is read with a single slice.
+        # returns the images and the number of h5 reads
+        ids = np.asarray(ids)
+        order = np.argsort(ids, kind='mergesort')
+        files = self.file_index[ids[order]]
+        rows = self.row_index[ids[order]]
+        breaks = np.flatnonzero(np.logical_or(files[1:] != files[:-1], rows[1:] - rows[:-1] > max_gap)) + 1
+        starts = np.concatenate([[0], breaks]).astype(np.int64)
+        ends = np.concatenate([breaks, [len(ids)]]).astype(np.int64)
+
+        out = [None] * len(ids)
+        for start, end in zip(starts, ends):
+            with self._pool.reading(files[start]) as handle:
+                block = handle[self._sensor_names[isensor]][rows[start]:rows[end - 1] + 1]
+            for k in range(start, end):
+                out[order[k]] = block[rows[k] - rows[start]]
+        return out, len(starts)
+
+
+class ArrayImages(object):
+    # The same interface as H5Images, over one (possibly memory mapped) N*H*W*C array per sensor
+    def __init__(self, arrays):
+        self._arrays = list(arrays)
+        # a single "file", whose rows are the frames
+        self.file_index = np.zeros(self._arrays[0].shape[0], dtype=np.int32)
+        self.row_index = np.arange(self._arrays[0].shape[0], dtype=np.int32)
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def num_frames(self):
+        return self._arrays[0].shape[0]
+
+    def read(self, isensor, i):
+        return self._arrays[isensor][i]
+
+    def read_batch(self, isensor, ids, max_gap=16):
+        # a single fancy indexing of the memory mapped array
+        return self._arrays[isensor][np.asarray(ids)], 1
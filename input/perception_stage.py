@@ -0,0 +1,71 @@
+import time, threading, collections, Queue
+
+
+class TaggedPerceptionStage(object):
+    # Runs the batches through the perception stack with several batches in flight.
+    # The batches are spread over num_lanes channels of the perception interface
+    # (perception_interface.compute_async_thread_channel), so that a slow lane does not hold back the others.
+    # Each batch gets an id when it is sent, and its targets and inputs wait here meanwhile. A lane returns
+    # its results in the order of its inputs, which maps each result back to its id.
+    # The reassembled batches come out in the order they complete.
+    # At most num_lanes * lane_depth batches are in flight, put blocks beyond that.
+    def __init__(self, perception_interface, num_lanes, lane_depth, output_queue, metrics, batch_size):
+        self._output_queue = output_queue
+        self._metrics = metrics
+        self._batch_size = batch_size
+        self._capacity = num_lanes * lane_depth
+        self._free = threading.Semaphore(self._capacity)
+        self._lock = threading.Lock()
+        # batch id -> (targets, inputs, the time the images were sent)
+        self._pending = {}
+        self._next_id = 0
+
+        self._lanes = []
+        for ilane in range(num_lanes):
+            lane = {"inputs": Queue.Queue(lane_depth), "ids": collections.deque(), "in_flight": 0}
+            outputs = perception_interface.compute_async_thread_channel(lane["inputs"])
+            metrics.add_queue("perception_lane%d" % ilane, lane["inputs"], lane_depth)
+            self._lanes.append(lane)
+            t = threading.Thread(target=self._thread_collect, args=(lane, outputs))
+            t.daemon = True
+            t.start()
+        # reported as a queue, whose depth is the number of batches in flight
+        metrics.add_queue("perception_in_flight", self, self._capacity)
+
+    def qsize(self):
+        with self._lock:
+            return len(self._pending)
+
+    def put(self, images, targets, inputs):
+        start = time.time()
+        # wait for a free place when the perception stack is the bottleneck
+        self._free.acquire()
+        self._metrics.add("perception_backpressure_seconds", time.time() - start)
+
+        with self._lock:
+            # the least loaded lane, which has a free place since fewer than capacity batches are in flight
+            lane = min(self._lanes, key=lambda lane: lane["in_flight"])
+            batch_id = self._next_id
+            self._next_id += 1
+            self._pending[batch_id] = (targets, inputs, time.time())
+            lane["ids"].append(batch_id)
+            lane["in_flight"] += 1
+            # in the same critical section as the id, so that the ids and the images of a lane are in the same
+            # order with several producers. It does not block: the lane has fewer than lane_depth batches in flight
+            lane["inputs"].put_nowait(images)
+        return batch_id
+
+    def _thread_collect(self, lane, outputs):
+        while True:
+            image_feature = outputs.get()
+            with self._lock:
+                batch_id = lane["ids"].popleft()
+                lane["in_flight"] -= 1
+                targets, inputs, sent = self._pending.pop(batch_id)
+            self._free.release()
+            self._metrics.record("perception", time.time() - sent, self._batch_size)
+
+            # the time waiting for the training to take the batch, when the perception stack is ahead
+            start = time.time()
+            self._output_queue.put([image_feature, targets, inputs])
+            self._metrics.add("perception_output_blocked_seconds", time.time() - start)
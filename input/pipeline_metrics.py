@@ -0,0 +1,121 @@
+import time
+import numpy as np
+from multiprocessing import Array
+
+# the stages of the input pipeline and of the training loop, in the order of the data flow
+STAGES = ["read", "decode", "augment", "perception", "feed", "gpu_step"]
+# plain counters, summed over the processes. The perception ones are the seconds the perception stage waited for
+# a free place in flight, and for the training to take its output. The checkpoint ones are the seconds the
+# training loop spent copying the variables of the checkpoints, and the seconds spent writing them in the background
+COUNTERS = ["read_bytes", "read_ops", "perception_backpressure_seconds", "perception_output_blocked_seconds",
+            "checkpoint_snapshot_seconds", "checkpoint_write_seconds"]
+# upper limits of the latency histogram buckets in seconds, from 1ms to ~16s, the last bucket is unbounded
+BUCKET_LIMITS = [0.001 * 2 ** k for k in range(15)]
+
+
+class PipelineMetrics(object):
+    # Latency histograms, sample counts and counters of the pipeline stages, in shared memory, so that the
+    # forked readers and decoders can record into them. It has to be created before forking them.
+    # Each stage holds: the bucket counts, then the number of records, the sum and the sum of squares of the
+    # seconds, and the number of samples processed.
+    _STAGE_SIZE = len(BUCKET_LIMITS) + 1 + 4
+
+    def __init__(self):
+        self._values = Array('d', len(STAGES) * self._STAGE_SIZE + len(COUNTERS))
+        # the queues whose depths are reported: name -> (queue, capacity)
+        self._queues = {}
+        self._last_values = None
+        self._last_time = None
+
+    def record(self, stage, seconds, samples=0):
+        offset = STAGES.index(stage) * self._STAGE_SIZE
+        ibucket = int(np.searchsorted(BUCKET_LIMITS, seconds))
+        with self._values.get_lock():
+            self._values[offset + ibucket] += 1
+            base = offset + len(BUCKET_LIMITS) + 1
+            self._values[base] += 1
+            self._values[base + 1] += seconds
+            self._values[base + 2] += seconds * seconds
+            self._values[base + 3] += samples
+
+    def add(self, counter, value):
+        with self._values.get_lock():
+            self._values[len(STAGES) * self._STAGE_SIZE + COUNTERS.index(counter)] += value
+
+    def totals(self, stage):
+        # the number of records and the seconds recorded for this stage since the start
+        base = STAGES.index(stage) * self._STAGE_SIZE + len(BUCKET_LIMITS) + 1
+        with self._values.get_lock():
+            return self._values[base], self._values[base + 1]
+
+    def add_queue(self, name, queue, capacity):
+        self._queues[name] = (queue, capacity)
+
+    def queue_depths(self):
+        return dict((name, queue.qsize()) for name, (queue, _) in self._queues.items())
+
+    def interval_summary(self):
+        # the statistics of each stage since the previous call, which is only made by the training process.
+        # returns {stage: dict(count, mean, p50, p90, samples_per_second, buckets, sum, sum_squares)},
+        # {counter: value per second, and read_ops_per_batch}, {queue: depth}
+        with self._values.get_lock():
+            values = np.array(self._values[:])
+        now = time.time()
+        if self._last_values is None:
+            delta, elapsed = values, None
+        else:
+            delta, elapsed = values - self._last_values, now - self._last_time
+        self._last_values, self._last_time = values, now
+
+        stages = {}
+        for istage, stage in enumerate(STAGES):
+            this = delta[istage * self._STAGE_SIZE:(istage + 1) * self._STAGE_SIZE]
+            buckets = this[:len(BUCKET_LIMITS) + 1]
+            count, total, sum_squares, samples = this[len(BUCKET_LIMITS) + 1:]
+            if count == 0:
+                continue
+            stages[stage] = {"count": count,
+                             "mean": total / count,
+                             "p50": self._percentile(buckets, 0.5),
+                             "p90": self._percentile(buckets, 0.9),
+                             "samples_per_second": samples / elapsed if elapsed else 0.0,
+                             "buckets": buckets,
+                             "sum": total,
+                             "sum_squares": sum_squares}
+
+        counters = {}
+        for icounter, counter in enumerate(COUNTERS):
+            value = delta[len(STAGES) * self._STAGE_SIZE + icounter]
+            counters[counter] = value / elapsed if elapsed else 0.0
+        if "read" in stages and elapsed:
+            counters["read_ops_per_batch"] = counters["read_ops"] * elapsed / stages["read"]["count"]
+
+        return stages, counters, self.queue_depths()
+
+    @staticmethod
+    def _percentile(buckets, q):
+        # the upper limit of the bucket holding the q-th quantile
+        cumulative = np.cumsum(buckets)
+        ibucket = int(np.searchsorted(cumulative, q * cumulative[-1]))
+        if ibucket >= len(BUCKET_LIMITS):
+            return float("inf")
+        return BUCKET_LIMITS[ibucket]
+
+    def log_line(self, stages, counters, queues):
+        # a single line summary of interval_summary
+        parts = []
+        for stage in STAGES:
+            if stage in stages:
+                s = stages[stage]
+                parts.append("%s %.3fs p90<%.3fs %.0f/s" % (stage, s["mean"], s["p90"], s["samples_per_second"]))
+        if "read_ops_per_batch" in counters:
+            parts.append("read %.1f MB/s %.1f h5 reads/batch" % (counters["read_bytes"] / 1e6,
+                                                                 counters["read_ops_per_batch"]))
+        full = counters.get("perception_backpressure_seconds", 0.0)
+        blocked = counters.get("perception_output_blocked_seconds", 0.0)
+        if full > 0 or blocked > 0:
+            # seconds per second, the fraction of the time
+            parts.append("perception full %.0f%% blocked %.0f%%" % (100 * full, 100 * blocked))
+        for name in sorted(queues):
+            parts.append("%s queue %d/%d" % (name, queues[name], self._queues[name][1]))
+        return "input pipeline: " + " | ".join(parts)
@@ -0,0 +1,263 @@
+import os, json, collections, threading
+import numpy as np
+
+
+class BalancedSampler(object):
+    # Draws the frame ids of the training batches, balanced across the control divisions and the steering bins
+    # of splited_keys: each division gets an equal share of the batch, each non empty bin of a division is
+    # picked uniformly, and so is the frame within the bin.
+    # The batch at a given position of the stream only depends on (seed, position), so that a run is
+    # reproducible, and a resumed run continues the same stream from the position saved with the checkpoint.
+    def __init__(self, splited_keys, batch_size, seed=None):
+        if seed is None:
+            # a fresh seed, still recorded with the checkpoints so that the run can be replayed
+            seed = int(np.random.RandomState().randint(0, 2**31 - 1))
+        self.seed = seed
+        self.position = 0
+        self._batch_size = batch_size
+
+        # for each division, the keys of its non empty bins concatenated, and where each bin starts and ends
+        self._divisions = []
+        for idivision, division in enumerate(splited_keys):
+            bins = [np.asarray(keys, dtype=np.int32) for keys in division if len(keys) > 0]
+            if len(bins) == 0:
+                raise ValueError("control division %d has no frames, the split has no frame of its commands" %
+                                 idivision)
+            lengths = np.array([len(keys) for keys in bins], dtype=np.int64)
+            self._divisions.append((np.concatenate(bins), np.cumsum(lengths) - lengths, lengths))
+
+    def _random_state(self, position):
+        return np.random.RandomState([self.seed, position])
+
+    def _division_sizes(self):
+        # the number of samples of each division in a batch, the last one takes the remainder
+        num_divisions = len(self._divisions)
+        sizes = [self._batch_size // num_divisions] * num_divisions
+        sizes[-1] = self._batch_size - (num_divisions - 1) * sizes[0]
+        return sizes
+
+    def _draw(self, rng):
+        ids = []
+        for (keys, starts, lengths), size in zip(self._divisions, self._division_sizes()):
+            chosen = rng.randint(0, len(lengths), size=size)
+            offsets = (rng.rand(size) * lengths[chosen]).astype(np.int64)
+            ids.append(keys[starts[chosen] + offsets])
+        return np.concatenate(ids).astype(np.int32)
+
+    def next_batch_ids(self):
+        # the frame ids of the next batch of the stream
+        ids = self._draw(self._random_state(self.position))
+        self.position += 1
+        return ids
+
+    def get_state(self, position=None):
+        # position: the position to record, such as the number of batches actually consumed by the training,
+        # which lags behind the batches already drawn by the input pipeline
+        if position is None:
+            position = self.position
+        return {"seed": self.seed, "position": int(position)}
+
+    def set_state(self, state):
+        self.seed = state["seed"]
+        self.position = state["position"]
+
+
+class EpochSampler(BalancedSampler):
+    # The same balancing of the divisions and the bins, but the frames of each bin are drawn without replacement,
+    # from a shuffled permutation of the bin that is reshuffled once exhausted, so that every frame of a bin is
+    # seen once per epoch of that bin. The ids of a batch are sorted, which groups the reads by h5 file, in the
+    # order of the rows, since the frames of a file are contiguous.
+    def __init__(self, splited_keys, batch_size, seed=None):
+        BalancedSampler.__init__(self, splited_keys, batch_size, seed)
+        # the global index of the first bin of each division
+        num_bins = [len(lengths) for _, _, lengths in self._divisions]
+        self._first_bin = np.cumsum(num_bins) - num_bins
+        self._bin_epochs = np.zeros(sum(num_bins), dtype=np.int64)
+        self._bin_pointers = np.zeros(sum(num_bins), dtype=np.int64)
+        self._permutations = {}
+        # the state before each of the recent batches, since the position to save lags behind the drawn batches
+        self._history = collections.deque(maxlen=1024)
+        # get_state is called by the training loop, while the reader thread draws the batches
+        self._lock = threading.Lock()
+
+    def _permutation(self, idivision, ibin):
+        # the order of the bin in its current epoch
+        iglobal = self._first_bin[idivision] + ibin
+        epoch = self._bin_epochs[iglobal]
+        if self._permutations.get(iglobal, (None,))[0] != epoch:
+            keys, starts, lengths = self._divisions[idivision]
+            rng = np.random.RandomState([self.seed, 2**31 + iglobal, epoch])
+            self._permutations[iglobal] = (epoch, keys[starts[ibin] + rng.permutation(lengths[ibin])])
+        return self._permutations[iglobal][1]
+
+    def _take(self, idivision, ibin, count):
+        iglobal = self._first_bin[idivision] + ibin
+        taken = []
+        while count > 0:
+            permutation = self._permutation(idivision, ibin)
+            pointer = self._bin_pointers[iglobal]
+            this = min(count, len(permutation) - pointer)
+            taken.append(permutation[pointer:pointer + this])
+            count -= this
+            if pointer + this == len(permutation):
+                self._bin_epochs[iglobal] += 1
+                self._bin_pointers[iglobal] = 0
+            else:
+                self._bin_pointers[iglobal] = pointer + this
+        return taken
+
+    def _draw(self, rng):
+        ids = []
+        for idivision, size in enumerate(self._division_sizes()):
+            lengths = self._divisions[idivision][2]
+            counts = np.bincount(rng.randint(0, len(lengths), size=size), minlength=len(lengths))
+            for ibin in np.flatnonzero(counts):
+                ids.extend(self._take(idivision, ibin, counts[ibin]))
+        return np.sort(np.concatenate(ids)).astype(np.int32)
+
+    def next_batch_ids(self):
+        with self._lock:
+            self._history.append((self.position, self._bin_epochs.copy(), self._bin_pointers.copy()))
+            return BalancedSampler.next_batch_ids(self)
+
+    def coverage(self):
+        # the fraction of the frames of the bins drawn at least once
+        lengths = np.concatenate([lengths for _, _, lengths in self._divisions])
+        seen = np.where(self._bin_epochs > 0, lengths, self._bin_pointers)
+        return float(seen.sum()) / lengths.sum()
+
+    def get_state(self, position=None):
+        with self._lock:
+            epochs, pointers = self._bin_epochs.copy(), self._bin_pointers.copy()
+            if position is not None and position != self.position:
+                for past_position, past_epochs, past_pointers in self._history:
+                    if past_position == position:
+                        epochs, pointers = past_epochs, past_pointers
+                        break
+                else:
+                    print("no sampler state at position", position, ", saving the state at", self.position)
+                    position = self.position
+            state = BalancedSampler.get_state(self, position)
+            state.update({"bin_epochs": epochs.tolist(), "bin_pointers": pointers.tolist(),
+                          "coverage": self.coverage()})
+            return state
+
+    def set_state(self, state):
+        BalancedSampler.set_state(self, state)
+        if "bin_epochs" in state:
+            self._bin_epochs = np.array(state["bin_epochs"], dtype=np.int64)
+            self._bin_pointers = np.array(state["bin_pointers"], dtype=np.int64)
+        self._permutations = {}
+        self._history.clear()
+
+
+class FileLocalitySampler(BalancedSampler):
+    # Reads a few contiguous windows of rows per batch, instead of one random row per sample.
+    # Each batch picks files_per_batch windows of window rows, centered on uniformly drawn frames. The divisions
+    # and the bins are drawn exactly as BalancedSampler does, but the frames of a bin are taken from the
+    # windows when they contain enough frames of that bin, and only fall back to random frames of the bin
+    # otherwise. The bins keep their proportions, while most frames come from a few contiguous row ranges,
+    # that H5Images.read_batch reads with one slice each.
+    def __init__(self, splited_keys, batch_size, seed, file_index, files_per_batch=8, window=None):
+        BalancedSampler.__init__(self, splited_keys, batch_size, seed)
+        self._files_per_batch = files_per_batch
+        if window is None:
+            window = 4 * int(np.ceil(batch_size * 1.0 / files_per_batch))
+        self._window = window
+
+        # the first and last + 1 frame of the file of each frame, the frames of a file being contiguous
+        file_index = np.asarray(file_index)
+        file_starts = np.flatnonzero(np.concatenate([[True], file_index[1:] != file_index[:-1]]))
+        file_ends = np.concatenate([file_starts[1:], [len(file_index)]])
+        self._frame_file_start = np.repeat(file_starts, file_ends - file_starts)
+        self._frame_file_end = np.repeat(file_ends, file_ends - file_starts)
+
+        # the global bin of each frame, -1 for the frames in no bin
+        self._bin_of_frame = np.full(len(file_index), -1, dtype=np.int32)
+        self._bins = []
+        for keys, starts, lengths in self._divisions:
+            for start, length in zip(starts, lengths):
+                self._bin_of_frame[keys[start:start + length]] = len(self._bins)
+                self._bins.append(keys[start:start + length])
+        self._all_keys = np.concatenate([keys for keys, _, _ in self._divisions])
+        self._first_bin = np.cumsum([len(lengths) for _, _, lengths in self._divisions]) - \
+                          [len(lengths) for _, _, lengths in self._divisions]
+
+    def _windows(self, rng):
+        centers = self._all_keys[rng.randint(0, len(self._all_keys), size=self._files_per_batch)]
+        starts = np.maximum(centers - self._window // 2, self._frame_file_start[centers])
+        ends = np.minimum(starts + self._window, self._frame_file_end[centers])
+        return np.unique(np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)]))
+
+    def _draw(self, rng):
+        candidates = self._windows(rng)
+        candidate_bins = self._bin_of_frame[candidates]
+
+        ids = []
+        for idivision, size in enumerate(self._division_sizes()):
+            lengths = self._divisions[idivision][2]
+            counts = np.bincount(rng.randint(0, len(lengths), size=size), minlength=len(lengths))
+            for ibin in np.flatnonzero(counts):
+                iglobal = self._first_bin[idivision] + ibin
+                in_windows = candidates[candidate_bins == iglobal]
+                taken = in_windows[rng.permutation(len(in_windows))[:counts[ibin]]]
+                missing = counts[ibin] - len(taken)
+                if missing > 0:
+                    # not enough frames of this bin in the windows, other random frames of the bin, without
+                    # replacement
+                    bin_keys = self._bins[iglobal]
+                    unused = np.setdiff1d(bin_keys, taken)
+                    taken = np.concatenate([taken, unused[rng.permutation(len(unused))[:missing]]])
+                    missing = counts[ibin] - len(taken)
+                if missing > 0:
+                    # a bin with fewer frames than its share of the batch, some of them twice, as BalancedSampler
+                    taken = np.concatenate([taken, bin_keys[rng.randint(0, len(bin_keys), size=missing)]])
+                ids.append(taken)
+        return np.sort(np.concatenate(ids)).astype(np.int32)
+
+
+def make_sampler(splited_keys, batch_size, seed, images, config):
+    # sampling_mode: "balanced" draws the frames with replacement (the default), "epoch" without, and
+    # "file_locality" from a few contiguous windows of rows per batch
+    sampling_mode = "balanced"
+    if hasattr(config, "sampling_mode"):
+        sampling_mode = config.sampling_mode
+
+    if sampling_mode == "balanced":
+        return BalancedSampler(splited_keys, batch_size, seed)
+    elif sampling_mode == "epoch":
+        return EpochSampler(splited_keys, batch_size, seed)
+    elif sampling_mode == "file_locality":
+        files_per_batch = 8
+        if hasattr(config, "locality_files_per_batch"):
+            files_per_batch = config.locality_files_per_batch
+        window = None
+        if hasattr(config, "locality_window"):
+            window = config.locality_window
+        return FileLocalitySampler(splited_keys, batch_size, seed, images.file_index, files_per_batch, window)
+    else:
+        raise ValueError("unknown sampling_mode " + str(sampling_mode))
+
+
+def worker_seed(seed, worker_id):
+    # an independent seed for each of the forked decoders, which otherwise inherit the same random state
+    return int(np.random.RandomState([seed, 2**31 + worker_id]).randint(0, 2**31 - 1))
+
+
+def state_path(checkpoint_path):
+    # stored next to the checkpoint files, such as model.ckpt-3000.sampler
+    return checkpoint_path + ".sampler"
+
+
+def save_state(models_path, i, state):
+    # the same naming as the checkpoints of CheckpointManager
+    with open(state_path(models_path + '/model.ckpt-' + str(i)), "w") as f:
+        json.dump(state, f)
+
+
+def load_state(checkpoint_path):
+    # None for checkpoints saved without a sampler state
+    if not os.path.exists(state_path(checkpoint_path)):
+        return None
+    with open(state_path(checkpoint_path), "r") as f:
+        return json.load(f)
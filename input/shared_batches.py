@@ -0,0 +1,43 @@
+import numpy as np
+from multiprocessing import sharedctypes
+from multiprocessing import Queue as mQueue
+
+
+class SharedBatchSlots(object):
+    # A ring of preallocated batches in shared memory, used to move the batches from the decoding processes
+    # to the feeding thread without pickling them. The slots have to be allocated before forking the workers.
+    # A worker acquires a free slot, writes its batch into the numpy views of the slot, and only sends the slot
+    # index to the consumer, who releases the slot once it is done with the views.
+    def __init__(self, template, num_slots):
+        # template: a list of arrays with the shapes and dtypes of one batch
+        self._shapes = [np.asarray(x).shape for x in template]
+        self._dtypes = [np.asarray(x).dtype for x in template]
+        self.num_slots = num_slots
+
+        self._views = []
+        for islot in range(num_slots):
+            views = []
+            for shape, dtype in zip(self._shapes, self._dtypes):
+                nbytes = int(np.prod(shape)) * dtype.itemsize
+                buffer = sharedctypes.RawArray('b', max(nbytes, 1))
+                views.append(np.frombuffer(buffer, dtype=np.uint8)[:nbytes].view(dtype).reshape(shape))
+            self._views.append(views)
+
+        self._free_queue = mQueue(num_slots)
+        for islot in range(num_slots):
+            self._free_queue.put(islot)
+
+    def acquire(self):
+        # blocks until a slot is free, returns the slot index
+        return self._free_queue.get()
+
+    def release(self, islot):
+        self._free_queue.put(islot)
+
+    def views(self, islot):
+        # the list of numpy arrays of this slot, in the same order as the template
+        return self._views[islot]
+
+    def nbytes(self):
+        return sum(int(np.prod(shape)) * dtype.itemsize for shape, dtype in zip(self._shapes, self._dtypes)) * \
+               self.num_slots
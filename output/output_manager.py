@@ -5,6 +5,7 @@ sys.path.append('../utils')
 
 from validation_manager import ValidationManager
 from codification import *
+from pipeline_metrics import BUCKET_LIMITS
 
 
 def convert_mat_to_tensor(py_mat, branch_config):
@@ -16,10 +17,12 @@ def convert_mat_to_tensor(py_mat, branch_config):
 
 
 class OutputManager(object):
-    def __init__(self, config, training_manager, config_train, sess, batch_tensor_val):
+    def __init__(self, config, training_manager, config_train, sess, batch_tensor_val, pipeline_metrics=None):
         self._config = config
         self._training_manager = training_manager
         self._sess = sess
+        # the PipelineMetrics of the training Dataset, reported every print_interval
+        self._pipeline_metrics = pipeline_metrics
 
         self.tensorboard_scalars()
         self.tensorboard_images()
@@ -81,6 +84,29 @@ class OutputManager(object):
 
         self._train_writer.add_summary(summary, i)
 
+    def write_pipeline_metrics(self, i):
+        # one log line, and the stage latencies, throughputs and queue depths to tensorboard
+        stages, counters, queues = self._pipeline_metrics.interval_summary()
+        print(self._pipeline_metrics.log_line(stages, counters, queues))
+
+        values = []
+        for stage in stages:
+            this = stages[stage]
+            values.append(tf.Summary.Value(tag='Pipeline/' + stage + '_seconds', simple_value=this["mean"]))
+            values.append(tf.Summary.Value(tag='Pipeline/' + stage + '_samples_per_second',
+                                           simple_value=this["samples_per_second"]))
+            # the last bucket is unbounded, tensorboard wants a finite limit
+            histogram = tf.HistogramProto(min=0.0, max=BUCKET_LIMITS[-1] * 2, num=this["count"], sum=this["sum"],
+                                          sum_squares=this["sum_squares"],
+                                          bucket_limit=BUCKET_LIMITS + [BUCKET_LIMITS[-1] * 2],
+                                          bucket=list(this["buckets"]))
+            values.append(tf.Summary.Value(tag='Pipeline/' + stage + '_latency', histo=histogram))
+        for counter in counters:
+            values.append(tf.Summary.Value(tag='Pipeline/' + counter, simple_value=counters[counter]))
+        for name in queues:
+            values.append(tf.Summary.Value(tag='Pipeline/queue_' + name, simple_value=queues[name]))
+        self._train_writer.add_summary(tf.Summary(value=values), i)
+
     def print_outputs(self, i, duration):
         self.duration_sum += duration
         # the dictonary of the data used for training
@@ -89,6 +115,8 @@ class OutputManager(object):
             # print("step=%d, images/second=%f, train loss=%f, validation loss=%f\n" % (i, 1.0*self._config/duration, 0.0, 0.0))
             print("step=%d, images/second=%f" % (i, 1.0 * self._config.batch_size / self.duration_sum * self._config.print_interval))
             self.duration_sum = 0.0
+            if self._pipeline_metrics is not None:
+                self.write_pipeline_metrics(i)
 
         """ Writing summary """
         if i % self._config.summary_writing_period == 0 or self.first_time:
@@ -83,6 +83,24 @@ def bias_variable(shape, name):
     # return tf.get_variable(name=name,initializer= tf.constant(0.1,shape=shape))
 
 
+def compute_dtype(config):
+    # mixed_precision: the layers compute in float16, while the variables stay float32 (the master weights)
+    # and are cast at each use, so that the optimizer updates them in float32
+    if hasattr(config, "mixed_precision") and config.mixed_precision:
+        return tf.float16
+    return tf.float32
+
+
+def cast_inputs(input_image, input_data, config):
+    # the inputs of a structure in its compute dtype, cast within the graph, so that the float32 speed, control
+    # or maps concatenate with the image features. The placeholders and the queue feed any float dtype
+    dtype = compute_dtype(config)
+    if input_image.dtype.base_dtype != dtype:
+        input_image = tf.cast(input_image, dtype)
+    input_data = [tf.cast(x, dtype) if x.dtype.base_dtype != dtype else x for x in input_data]
+    return input_image, input_data
+
+
 class Network(object):
     def __init__(self, config, dropout, image_shape):
 
@@ -102,12 +120,25 @@ class Network(object):
         self._conv_strides = []
         self._weights = {}
         self._features = {}
+        # the dtype of the computations, see compute_dtype
+        self.dtype = compute_dtype(config)
+
+    def to_compute_dtype(self, x):
+        # the layer inputs and the float32 variables, in the dtype of the computations
+        if x.dtype.base_dtype != self.dtype:
+            return tf.cast(x, self.dtype)
+        return x
+
+    def concat(self, values, axis):
+        # tf.concat of layers and of float32 tensors, such as the resized maps, in the compute dtype
+        return tf.concat([self.to_compute_dtype(x) for x in values], axis)
 
     """ Our conv is currently using bias """
 
     def conv(self, x, kernel_size, stride, output_size, padding_in='SAME'):
 
         self._count_conv += 1
+        x = self.to_compute_dtype(x)
 
         filters_in = x.get_shape()[-1]
         shape = [kernel_size, kernel_size, filters_in, output_size]
@@ -119,8 +150,8 @@ class Network(object):
         self._conv_kernels.append(kernel_size)
         self._conv_strides.append(stride)
 
-        conv_res = tf.add(tf.nn.conv2d(x, weights, [1, stride, stride, 1], padding=padding_in,
-                                       name='conv2d_' + str(self._count_conv)), bias,
+        conv_res = tf.add(tf.nn.conv2d(x, self.to_compute_dtype(weights), [1, stride, stride, 1], padding=padding_in,
+                                       name='conv2d_' + str(self._count_conv)), self.to_compute_dtype(bias),
                           name='add_' + str(self._count_conv))
 
         self._features['conv_block' + str(self._count_conv - 1)] = conv_res
@@ -134,8 +165,10 @@ class Network(object):
 
     def bn(self, x):
         self._count_bn += 1
-        return tf.contrib.layers.batch_norm(x, is_training=self._config.is_training, updates_collections=None,
-                                            scope='bn' + str(self._count_bn))
+        # the statistics and the parameters of the batch norm stay in float32
+        normalized = tf.contrib.layers.batch_norm(tf.cast(x, tf.float32), is_training=self._config.is_training,
+                                                  updates_collections=None, scope='bn' + str(self._count_bn))
+        return tf.cast(normalized, x.dtype)
 
     def activation(self, x):
         self._count_activations += 1
@@ -144,7 +177,7 @@ class Network(object):
     def dropout(self, x):
         print("Dropout", self._count_dropouts)
         self._count_dropouts += 1
-        output = tf.nn.dropout(x, self._dropout_vec[self._count_dropouts - 1],
+        output = tf.nn.dropout(x, tf.cast(self._dropout_vec[self._count_dropouts - 1], x.dtype),
                                name='dropout' + str(self._count_dropouts))
 
         return output
@@ -152,6 +185,7 @@ class Network(object):
     def fc(self, x, output_size):
 
         self._count_fc += 1
+        x = self.to_compute_dtype(x)
         filters_in = x.get_shape()[-1]
         shape = [filters_in, output_size]
 
@@ -160,7 +194,8 @@ class Network(object):
 
         self.last_variables = [weights, bias]
 
-        return tf.nn.xw_plus_b(x, weights, bias, name='fc_' + str(self._count_fc))
+        return tf.nn.xw_plus_b(x, self.to_compute_dtype(weights), self.to_compute_dtype(bias),
+                               name='fc_' + str(self._count_fc))
 
     def gated_block(self, x, h, output_size):
 
@@ -193,7 +228,8 @@ class Network(object):
         weights = weight_xavi_init(shape, 'W_fc_gate' + str(self._count_fc))
         bias = bias_variable([output_size], name='W_b_fc_gate' + str(self._count_fc))
 
-        return tf.nn.xw_plus_b(y, weights, bias, name='fc' + str(self._count_fc))
+        return tf.nn.xw_plus_b(self.to_compute_dtype(y), self.to_compute_dtype(weights), self.to_compute_dtype(bias),
+                               name='fc' + str(self._count_fc))
 
     def soft_max(self, x):
         self._count_soft_max += 1
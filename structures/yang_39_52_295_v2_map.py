@@ -78,7 +78,7 @@ def create_structure(tf, input_image, input_data, input_size, dropout, config):
     # size 39*52*64
 
     # concat the map with the image
-    xc = tf.concat([xc, mapping], 3)
+    xc = network_manager.concat([xc, mapping], 3)
     # end of mapping concat
 
     print(xc)
@@ -1,4 +1,4 @@
-import sys, time
+import sys, time, os
 
 sys.path.append('configuration')
 sys.path.append('input')
@@ -10,8 +10,12 @@ sys.path.append('../')
 from common_util import restore_session
 
 from dataset_manager import *
-from training_manager import TrainManager, get_last_iteration, save_model
+from training_manager import TrainManager, get_last_iteration
+from checkpoint_manager import CheckpointManager
 from output_manager import OutputManager
+import samplers
+import feature_cache
+import compiled_dataset
 
 from all_perceptions import Perceptions
 
@@ -19,36 +23,73 @@ import tensorflow as tf
 slim = tf.contrib.slim
 
 
+def create_perception_interface(config_input):
+    # the perception stack of the config, whose networks run on the perception_gpus
+    use_mode = {}
+    for key in config_input.perception_num_replicates:
+        if config_input.perception_num_replicates[key] > 0:
+            assert (config_input.batch_size % config_input.perception_batch_sizes[key] == 0)
+            use_mode[key] = True
+        else:
+            use_mode[key] = False
+
+    all_params = use_mode.copy()
+    if hasattr(config_input, "perception_other_params"):
+        all_params.update(config_input.perception_other_params)
+
+    perception_interface = Perceptions(
+        batch_size=config_input.perception_batch_sizes,
+        gpu_assignment=config_input.perception_gpus,
+        compute_methods={},
+        viz_methods={},
+        num_replicates=config_input.perception_num_replicates,
+        path_config=config_input.perception_paths,
+        **all_params
+    )
+    time.sleep(config_input.perception_initialization_sleep)
+    return perception_interface
+
+
+def perception_stack_needed(config_input):
+    # the perception stack is not needed when the training and the validation read cached features, which
+    # requires no augmentation before the perception stack
+    if not config_input.use_perception_stack:
+        return False
+    if not hasattr(config_input, "perception_feature_cache") or config_input.perception_feature_cache is None:
+        return True
+    if any(augmenter != None for augmenter in config_input.augment):
+        return True
+    compiled_db_path = config_input.compiled_db_path if hasattr(config_input, "compiled_db_path") else None
+    for split, file_names in [("train", config_input.train_db_path), ("val", config_input.val_db_path)]:
+        # the files in the order of the frames, as DatasetManager.frame_files
+        file_names = compiled_dataset.frame_order(file_names, compiled_dataset.store_path(compiled_db_path, split))
+        if not feature_cache.matches(feature_cache.store_path(config_input.perception_feature_cache, split),
+                                     file_names):
+            return True
+    return False
+
+
+def scale_to_towers(config, num_towers):
+    # with num_gpus towers, the configured batch sizes are the ones of a tower, while the input pipeline, the
+    # validation and the throughput reports work on the batch of all the towers. queue_capacity is measured in
+    # batches, so the queues hold num_towers times more samples
+    config.batch_size *= num_towers
+    if hasattr(config, "batch_size_val"):
+        config.batch_size_val *= num_towers
+        config.number_images_val *= num_towers
+    return config
+
+
 def train(experiment_name, memory_fraction):
     """ Initialize the input class to get the configuration """
     conf_module = __import__(experiment_name)
     config_main = conf_module.configMain()
     config_input = conf_module.configInput()
+    num_towers = config_main.num_gpus if hasattr(config_main, "num_gpus") else 1
+    scale_to_towers(config_input, num_towers)
 
-    if config_input.use_perception_stack:
-        use_mode = {}
-        for key in config_input.perception_num_replicates:
-            if config_input.perception_num_replicates[key] > 0:
-                assert (config_input.batch_size % config_input.perception_batch_sizes[key] == 0)
-                use_mode[key] = True
-            else:
-                use_mode[key] = False
-
-        all_params = use_mode.copy()
-        if hasattr(config_input, "perception_other_params"):
-            all_params.update(config_input.perception_other_params)
-
-        perception_interface = Perceptions(
-            batch_size=config_input.perception_batch_sizes,
-            gpu_assignment=config_input.perception_gpus,
-            compute_methods={},
-            viz_methods={},
-            num_replicates=config_input.perception_num_replicates,
-            path_config=config_input.perception_paths,
-            **all_params
-        )
-        time.sleep(config_input.perception_initialization_sleep)
-
+    if perception_stack_needed(config_input):
+        perception_interface = create_perception_interface(config_input)
     else:
         perception_interface = None
 
@@ -57,9 +98,19 @@ def train(experiment_name, memory_fraction):
     sess = tf.Session(config=config_gpu)
 
 
-    dataset_manager = DatasetManager(conf_module.configInput(), perception_interface)
+    dataset_manager = DatasetManager(config_input, perception_interface)
     batch_tensor = dataset_manager.train.get_batch_tensor()
     batch_tensor_val = dataset_manager.validation.get_batch_tensor()
+
+    # continue the sampling stream from the position saved with the last checkpoint, before the queueing starts
+    last_ckpt = tf.train.get_checkpoint_state(config_main.models_path) if os.path.exists(config_main.models_path) else None
+    if last_ckpt:
+        sampler_state = samplers.load_state(last_ckpt.model_checkpoint_path)
+        if sampler_state is not None:
+            print("resuming the sampling stream at", sampler_state)
+            dataset_manager.train.sampler.set_state(sampler_state)
+    sampler_start = dataset_manager.train.sampler.position
+
     dataset_manager.start_training_queueing(sess)
     dataset_manager.start_validation_queueing(sess)
 
@@ -96,24 +147,34 @@ def train(experiment_name, memory_fraction):
     else:
         initialIteration = get_last_iteration(cpkt)
 
-    all_saver = tf.train.Saver(tf.global_variables(), max_to_keep=0)
+    # the ctrl checkpoints hold the variables without the segmentation model, next to the checkpoints of all of them.
+    # checkpoint_keep_last and checkpoint_keep_every: the checkpoints kept, the others are deleted once written
+    checkpoint_targets = [(config_main.models_path, tf.global_variables())]
+    if config_main.segmentation_model != None:
+        checkpoint_targets.append((config_main.models_path + '/ctrl', variables_to_restore))
+    keep_last = config_main.checkpoint_keep_last if hasattr(config_main, "checkpoint_keep_last") else 5
+    keep_every = config_main.checkpoint_keep_every if hasattr(config_main, "checkpoint_keep_every") else 30000
+    checkpoint_manager = CheckpointManager(sess, checkpoint_targets, keep_last, keep_every,
+                                           metrics=dataset_manager.train.metrics)
+    checkpoint_period = config_main.checkpoint_period if hasattr(config_main, "checkpoint_period") else 3000
 
     # Creates a manager to manger the screen output and also validation outputs
     if config_main.output_is_on:
-        output_manager = OutputManager(conf_module.configOutput(), training_manager, conf_module.configTrain(), sess,
-                                       batch_tensor_val)
+        config_output = scale_to_towers(conf_module.configOutput(), num_towers)
+        output_manager = OutputManager(config_output, training_manager, conf_module.configTrain(), sess,
+                                       batch_tensor_val, dataset_manager.train.metrics)
 
     # Creates a test manager that connects to a server and tests there constantly
 
     for i in range(initialIteration, config_main.number_iterations):
         start_time = time.time()
-        if i % 3000 == 0:
-            if config_main.segmentation_model != None:
-                save_model(saver, sess, config_main.models_path + '/ctrl', i)
-            save_model(all_saver, sess, config_main.models_path, i)
+        if i % checkpoint_period == 0:
+            # the position of the batches consumed so far, the input pipeline has already drawn a few more
+            checkpoint_manager.save(i, dataset_manager.train.sampler.get_state(sampler_start + i - initialIteration))
 
         #print("running a step")
-        training_manager.run_train_step(batch_tensor, sess, i)
+        step_time = training_manager.run_train_step(batch_tensor, sess, i)
+        dataset_manager.train.report_step_time(step_time)
         #print("finished a step")
 
         duration = time.time() - start_time
@@ -121,3 +182,5 @@ def train(experiment_name, memory_fraction):
         #   """ With the current trained net, let the outputmanager print and save all the outputs """
         if config_main.output_is_on:
             output_manager.print_outputs(i, duration)
+
+    checkpoint_manager.wait()
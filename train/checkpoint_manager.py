@@ -0,0 +1,137 @@
+import os, glob, re, time, threading, Queue
+import tensorflow as tf
+import samplers
+
+
+def checkpoint_iterations(models_path):
+    # the iterations of the model.ckpt-<iteration> checkpoints written in models_path
+    iterations = []
+    for index in glob.glob(os.path.join(models_path, "model.ckpt-*.index")):
+        match = re.match(r"model\.ckpt-(\d+)\.index$", os.path.basename(index))
+        if match:
+            iterations.append(int(match.group(1)))
+    return sorted(iterations)
+
+
+def retained(iterations, keep_last, keep_every):
+    # the last keep_last iterations, and every keep_every-th iteration when keep_every is set
+    kept = set(iterations[-keep_last:]) if keep_last > 0 else set()
+    if keep_every:
+        kept.update(i for i in iterations if i % keep_every == 0)
+    return kept
+
+
+class CheckpointManager(object):
+    # Saves the checkpoints without stalling the training loop for the disk writes.
+    # save copies the variables to host memory, with a single session run for all the targets, and a background
+    # thread writes them to disk through a copy of the variables in a separate cpu graph, so that the files are
+    # regular checkpoints, named as save_model names them. The checkpoint state of a directory is only updated
+    # once its checkpoint is fully written, then the older checkpoints are pruned to the retention policy.
+    # The .meta files hold the training graph, exported once, as the savers of the training graph wrote them.
+    # At most one checkpoint waits for its write, a save blocks if the previous one is still pending.
+    def __init__(self, sess, targets, keep_last=5, keep_every=None, metrics=None):
+        # targets: (models_path, variables) for each checkpoint directory, such as the ctrl variables and all of them
+        self._sess = sess
+        self._targets = targets
+        self._keep_last = keep_last
+        self._keep_every = keep_every
+        # the PipelineMetrics of the training Dataset, for the checkpoint seconds counters
+        self._metrics = metrics
+
+        self._variables = []
+        for _, variables in targets:
+            for v in variables:
+                if v not in self._variables:
+                    self._variables.append(v)
+        # created in the writer thread, on first use
+        self._writers = [None] * len(targets)
+        # the meta graph of each target, with the saver of its variables in the training graph
+        self._meta_graphs = []
+        for _, variables in targets:
+            saver = tf.train.Saver(variables, max_to_keep=0)
+            self._meta_graphs.append(saver.export_meta_graph().SerializeToString())
+
+        self._pending = Queue.Queue(1)
+        t = threading.Thread(target=self._thread_write)
+        t.daemon = True
+        t.start()
+
+    def save(self, i, sampler_state=None):
+        # sampler_state: the state of the training sampler at i, written next to the checkpoint of the first target
+        # once its files exist, so that a sampler state is never ahead of its checkpoint
+        start = time.time()
+        values = dict(zip(self._variables, self._sess.run(self._variables)))
+        snapshot_seconds = time.time() - start
+        # waits for the previous checkpoint when the disk is slower than the checkpoint period
+        self._pending.put((i, values, sampler_state))
+        blocked_seconds = time.time() - start - snapshot_seconds
+        print("checkpoint %d: %.2fs to copy the variables, %.2fs waiting for the previous write" %
+              (i, snapshot_seconds, blocked_seconds))
+        if self._metrics is not None:
+            self._metrics.add("checkpoint_snapshot_seconds", snapshot_seconds + blocked_seconds)
+
+    def wait(self):
+        # returns once the pending checkpoint is written
+        self._pending.join()
+
+    def _writer(self, itarget):
+        # a cpu copy of the variables of the target, initialized from placeholders, and its saver, keyed by the
+        # names of the original variables
+        if self._writers[itarget] is None:
+            graph = tf.Graph()
+            placeholders = {}
+            copies = {}
+            with graph.as_default(), tf.device('/cpu:0'):
+                for v in self._targets[itarget][1]:
+                    placeholders[v] = tf.placeholder(v.dtype.base_dtype, shape=v.get_shape())
+                    copies[v.op.name] = tf.Variable(placeholders[v], trainable=False)
+                init = tf.variables_initializer(list(copies.values()))
+                saver = tf.train.Saver(copies, max_to_keep=None)
+            sess = tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+            self._writers[itarget] = (sess, placeholders, init, saver)
+        return self._writers[itarget]
+
+    def _thread_write(self):
+        while True:
+            i, values, sampler_state = self._pending.get()
+            start = time.time()
+            for itarget, (models_path, _) in enumerate(self._targets):
+                sess, placeholders, init, saver = self._writer(itarget)
+                feed_dict = {}
+                for v in placeholders:
+                    feed_dict[placeholders[v]] = values[v]
+                sess.run(init, feed_dict=feed_dict)
+                if not os.path.exists(models_path):
+                    os.makedirs(models_path)
+                # the state is written below, once the older checkpoints are pruned. The meta graph of the cpu
+                # copy is not the training graph, the one of the training graph is written instead
+                path = saver.save(sess, models_path + '/model.ckpt', global_step=i, write_meta_graph=False,
+                                  write_state=False)
+                with open(path + ".meta", "wb") as f:
+                    f.write(self._meta_graphs[itarget])
+                if itarget == 0 and sampler_state is not None:
+                    samplers.save_state(models_path, i, sampler_state)
+                self._prune(models_path, path, i)
+            feed_dict = None
+            values = None
+            write_seconds = time.time() - start
+            print("checkpoint %d written in %.2fs" % (i, write_seconds))
+            if self._metrics is not None:
+                self._metrics.add("checkpoint_write_seconds", write_seconds)
+            self._pending.task_done()
+
+    def _prune(self, models_path, path, i):
+        # removes the checkpoints up to i that are out of the retention policy, with their sampler states,
+        # then points the checkpoint state to the new checkpoint
+        iterations = [it for it in checkpoint_iterations(models_path) if it <= i]
+        kept = retained(iterations, self._keep_last, self._keep_every)
+        for it in iterations:
+            if it not in kept:
+                prefix = os.path.join(models_path, "model.ckpt-%d" % it)
+                names = glob.glob(prefix + ".data-*") + [prefix + ".index", prefix + ".meta",
+                                                         samplers.state_path(prefix)]
+                for name in names:
+                    if os.path.exists(name):
+                        os.remove(name)
+        kept_paths = [models_path + '/model.ckpt-' + str(it) for it in sorted(kept) if it != i]
+        tf.train.update_checkpoint_state(models_path, path, all_model_checkpoint_paths=kept_paths + [path])
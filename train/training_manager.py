@@ -1,4 +1,4 @@
-import sys, time, os
+import sys, time, os, contextlib
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
 sys.path.append('train')
@@ -8,6 +8,7 @@ sys.path.append('structures')
 import loss_functions
 from enet import *
 from erfnet import *
+import network
 from network import one_hot_to_image, image_to_one_hot, label_to_one_hot
 
 def save_model(saver, sess, models_path, i):
@@ -24,6 +25,60 @@ def get_last_iteration(ckpt):
     else:
         return 1
 
+
+def cast_outputs(outputs, dtype):
+    # the network outputs are tensors, or lists and tuples of them, such as the branches and their sigmas
+    if isinstance(outputs, (list, tuple)):
+        return type(outputs)(cast_outputs(x, dtype) for x in outputs)
+    # the distributions of the GMM structures are left as they are
+    if isinstance(outputs, tf.Tensor) and outputs.dtype.base_dtype != dtype:
+        return tf.cast(outputs, dtype)
+    return outputs
+
+
+def concat_towers(tower_values):
+    # the same structure from every tower, lists and tuples of per sample tensors, concatenated along the batch.
+    # the scalar tensors are averaged, and anything else, such as None, is taken from the first tower
+    first = tower_values[0]
+    if len(tower_values) == 1:
+        return first
+    if isinstance(first, (list, tuple)):
+        return type(first)(concat_towers([value[i] for value in tower_values]) for i in range(len(first)))
+    if isinstance(first, tf.Tensor):
+        if first.get_shape().ndims == 0:
+            return tf.add_n(list(tower_values)) / float(len(tower_values))
+        return tf.concat(list(tower_values), 0)
+    return first
+
+
+def shared_variables(itower):
+    # a variable creator for the tower itower, which returns the tf.Variable of the first tower with the same name
+    # without the tower name scope, the reusing variable scope only shares the get_variable variables. A variable
+    # that the first tower does not have is created in the tower
+    prefix = "tower_%d/" % itower
+    first_tower = {}
+    for v in tf.global_variables():
+        first_tower[v.op.name] = v
+
+    def creator(next_creator, **kwargs):
+        # the name the variable would get in the tower
+        name = tf.get_default_graph().unique_name(kwargs.get("name") or "Variable")
+        if name.startswith(prefix) and name[len(prefix):] in first_tower:
+            return first_tower[name[len(prefix):]]
+        return next_creator(**kwargs)
+    return creator
+
+
+def average_gradients(tower_grads):
+    # tower_grads: the (gradient, variable) list of each tower, in the same variable order
+    averaged = []
+    for grads_and_vars in zip(*tower_grads):
+        grads = [tf.convert_to_tensor(grad) for grad, _ in grads_and_vars if grad is not None]
+        if len(grads) == 0:
+            continue
+        averaged.append((tf.add_n(grads) / float(len(grads)), grads_and_vars[0][1]))
+    return averaged
+
 # with the name of TrainManager, it actually is a Network manager
 class TrainManager(object):
     def __init__(self, config, reuse, placeholder_input=True, batch_tensor=None):
@@ -31,6 +86,16 @@ class TrainManager(object):
         self._config = config
         self._reuse = reuse
         self._placeholder_input = placeholder_input
+        # mixed_precision: the network computes in float16 on float32 master weights, see Network,
+        # and the loss is scaled so that the small float16 gradients do not vanish
+        self._mixed_precision = hasattr(config, "mixed_precision") and config.mixed_precision
+        # num_gpus: synchronous data parallel training, the batch of the queue is split into num_gpus towers that
+        # share the variables, and config.batch_size is the batch of one tower
+        self._num_towers = 1
+        if not placeholder_input and hasattr(config, "num_gpus"):
+            self._num_towers = config.num_gpus
+        # the images, the targets and the inputs of each tower, split on first use
+        self._tower_inputs = None
 
         with tf.device('/gpu:0'):
             if placeholder_input:
@@ -60,42 +125,132 @@ class TrainManager(object):
         self._loss_function = getattr(loss_functions, config.loss_function)  # The function to call
 
 
+    @contextlib.contextmanager
+    def tower_scope(self, itower):
+        # the device and the scopes of a tower. The first tower has no name scope of its own, so that its plain
+        # tf.Variables, such as the biases of Network, which follow the name scope, have the names of a single tower
+        # graph, and the single and multi gpu checkpoints are interchangeable. The other towers reuse the variables
+        # of the first one, get_variable through the variable scope, and the tf.Variables through shared_variables
+        if itower == 0:
+            with tf.device('/gpu:0'):
+                yield
+            return
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True), tf.device('/gpu:%d' % itower), \
+                tf.name_scope("tower_%d/" % itower), tf.variable_creator_scope(shared_variables(itower)):
+            yield
+
+    def towers(self):
+        # yields the index, the images, the targets and the inputs of each tower, the batch is split once. With
+        # several towers, the loop body runs within tower_scope
+        if self._num_towers == 1:
+            yield 0, self._input_images, self._targets_data, self._input_data
+            return
+
+        if self._tower_inputs is None:
+            images = tf.split(self._input_images, self._num_towers, 0)
+            targets = [tf.split(x, self._num_towers, 0) for x in self._targets_data]
+            inputs = [tf.split(x, self._num_towers, 0) for x in self._input_data]
+            self._tower_inputs = [(images[itower], [x[itower] for x in targets], [x[itower] for x in inputs])
+                                  for itower in range(self._num_towers)]
+        for itower in range(self._num_towers):
+            with self.tower_scope(itower):
+                input_images, targets_data, input_data = self._tower_inputs[itower]
+                yield itower, input_images, targets_data, input_data
+
     def build_network(self):
         """ Depends on the actual input """
-        with tf.name_scope("Network"):
-            self._output_network, self._vis_images, self._features, self._weights, self._branch_vars = self._create_structure(tf,
-                                                                                                           self._input_images,
-                                                                                                           self._input_data,
-                                                                                                           self._config.image_size,
-                                                                                                           self._dout,
-                                                                                                           self._config)
+        towers = []
+        for itower, input_images, _, input_data in self.towers():
+            with tf.name_scope("Network"):
+                input_images, input_data = network.cast_inputs(input_images, input_data, self._config)
+                towers.append(self._create_structure(tf, input_images, input_data, self._config.image_size,
+                                                     self._dout, self._config))
+        # the other outputs of the structure, such as the weights, are the ones of the first tower
+        self._output_network, self._vis_images, self._features, self._weights, self._branch_vars = towers[0]
+
+        self._tower_outputs = [outputs[0] for outputs in towers]
+        if self._mixed_precision:
+            # the loss, the summaries and the drivers get float32 outputs
+            self._tower_outputs = cast_outputs(self._tower_outputs, tf.float32)
+        self._output_network = concat_towers(self._tower_outputs)
 
     def build_seg_network_erfnet_one_hot(self):
         """ Depends on the actual input """
-        self._seg_network = ErfNet_Small(self._input_images[:, :, :, 0:3], self._config.number_of_labels,
-                                         batch_size=self._config.batch_size, reuse=self._reuse,
-                                         is_training=self._config.train_segmentation)[0]
-        with tf.name_scope("Network"):
-            # with tf.variable_scope("Network",reuse=self._reuse):
-            # print  self._seg_network
-
-            self._sensor_input = self._seg_network
-            # Just for visualization
-            self._gray = one_hot_to_image(self._seg_network)
-            self._gray = tf.expand_dims(self._gray, -1)
-
-            self._output_network, self._vis_images, self._features, self._weights \
-                = self._create_structure(tf, self._sensor_input, self._input_data, self._config.image_size, self._dout,
-                                         self._config)
+        towers = []
+        grays = []
+        for itower, input_images, _, input_data in self.towers():
+            seg_network = ErfNet_Small(tf.cast(input_images[:, :, :, 0:3], tf.float32), self._config.number_of_labels,
+                                       batch_size=self._config.batch_size,
+                                       reuse=True if itower > 0 else self._reuse,
+                                       is_training=self._config.train_segmentation)[0]
+            with tf.name_scope("Network"):
+                # with tf.variable_scope("Network",reuse=self._reuse):
+                # print  self._seg_network
+
+                # Just for visualization
+                gray = one_hot_to_image(seg_network)
+                grays.append(tf.expand_dims(gray, -1))
+
+                structure_input, input_data = network.cast_inputs(seg_network, input_data, self._config)
+                towers.append(self._create_structure(tf, structure_input, input_data, self._config.image_size,
+                                                     self._dout, self._config))
+            if itower == 0:
+                self._seg_network = seg_network
+                self._sensor_input = seg_network
+        self._gray = concat_towers(grays)
+        self._output_network, self._vis_images, self._features, self._weights = towers[0]
+
+        self._tower_outputs = [outputs[0] for outputs in towers]
+        if self._mixed_precision:
+            self._tower_outputs = cast_outputs(self._tower_outputs, tf.float32)
+        self._output_network = concat_towers(self._tower_outputs)
 
     def build_loss(self):
-        with tf.name_scope("Loss"):
-            self._loss, self._variable_error, self._variable_energy, self._image_loss, self._branch \
-                = self._loss_function(self._output_network,
-                                      self._targets_data,
-                                      self._input_data[self._config.inputs_names.index("Control")],
-                                      self._config,
-                                      all_inputs=self._input_data)
+        towers = []
+        for itower, _, targets_data, input_data in self.towers():
+            with tf.name_scope("Loss"):
+                towers.append(self._loss_function(self._tower_outputs[itower],
+                                                  targets_data,
+                                                  input_data[self._config.inputs_names.index("Control")],
+                                                  self._config,
+                                                  all_inputs=input_data))
+        # the per sample losses, errors and energies of the whole batch, for the summaries and the validation
+        self._tower_losses = [loss[0] for loss in towers]
+        self._loss, self._variable_error, self._variable_energy, self._image_loss, self._branch \
+            = concat_towers(towers)
+
+    def loss_scaled(self, optimizer):
+        # wraps the optimizer to scale the loss under mixed_precision, the gradients are unscaled before being
+        # applied to the float32 variables. loss_scale is a fixed scale, or "dynamic" (the default): the scale
+        # is halved and the step skipped when the gradients overflow, and doubled after 2000 finite steps
+        if not self._mixed_precision:
+            return optimizer
+        if not hasattr(tf.contrib, "mixed_precision"):
+            raise ImportError("mixed_precision needs tf.contrib.mixed_precision, tensorflow >= 1.14 and < 2, found " +
+                              tf.__version__)
+        loss_scale = "dynamic"
+        if hasattr(self._config, "loss_scale"):
+            loss_scale = self._config.loss_scale
+        if loss_scale == "dynamic":
+            manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(init_loss_scale=2 ** 15,
+                                                                                   incr_every_n_steps=2000)
+        else:
+            manager = tf.contrib.mixed_precision.FixedLossScaleManager(loss_scale)
+        print("Optimizer: mixed precision, loss scale ", loss_scale)
+        return tf.contrib.mixed_precision.LossScaleOptimizer(optimizer, manager)
+
+    def minimize(self, optimizer, var_list=None):
+        optimizer = self.loss_scaled(optimizer)
+        if self._num_towers == 1:
+            return optimizer.minimize(self._loss, var_list=var_list)
+
+        # each tower computes the gradients of its part of the batch, on its gpu, and the variables are updated
+        # once with their average, so that a step has the same scale as a single tower step
+        tower_grads = []
+        for itower in range(self._num_towers):
+            with self.tower_scope(itower):
+                tower_grads.append(optimizer.compute_gradients(self._tower_losses[itower], var_list=var_list))
+        return optimizer.apply_gradients(average_gradients(tower_grads))
 
     def build_optimization(self):
         """ List of Interesting Parameters """
@@ -116,16 +271,16 @@ class TrainManager(object):
                 #train_vars = slim.get_variables(scope="Branch_" + str(self._config.only_train_branch))
                 train_vars = self._branch_vars[self._config.only_train_branch]
                 print("Optimizer: only train those variables: ", train_vars)
-                self._train_step = opt(self._variable_learning, **opt_kwargs).minimize(self._loss, var_list=train_vars)
+                self._train_step = self.minimize(opt(self._variable_learning, **opt_kwargs), var_list=train_vars)
             elif hasattr(self._config, 'finetune_segmentation') or \
                     not (hasattr(self._config, 'segmentation_model_name')) or \
                     self._config.segmentation_model is None:
-                self._train_step = opt(self._variable_learning, **opt_kwargs).minimize(self._loss)
+                self._train_step = self.minimize(opt(self._variable_learning, **opt_kwargs))
                 print("Optimizer: All variables")
             else:
                 train_vars = list(set(tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)) -
                                   set(slim.get_variables(scope=str(self._config.segmentation_model_name))))
-                self._train_step = opt(self._variable_learning, **opt_kwargs).minimize(self._loss, var_list=train_vars)
+                self._train_step = self.minimize(opt(self._variable_learning, **opt_kwargs), var_list=train_vars)
                 print("Optimizer: Exclude variables from: ", str(self._config.segmentation_model_name))
 
     def run_train_step(self, batch_tensor, sess, i):
@@ -29,6 +29,18 @@ def encode(value):
         return [0, 0, 0, 1]
 
 
+def encode_batch(values):
+    # vectorized version of encode, values is a 1d array of controls, returns a len(values)*4 matrix
+    values = np.asarray(values)
+    ans = np.zeros((values.shape[0], 4))
+    ans[:, 3] = 1
+    for value, k in ((2.0, 0), (5.0, 1), (3.0, 2)):
+        hit = (values == value)
+        ans[hit, 3] = 0
+        ans[hit, k] = 1
+    return ans
+
+
 def encode4(value):
     if value == 5.0:
         return [0, 1, 0, 0]
@@ -69,3 +81,9 @@ def check_distance(value):
     if value < 0.0:
         return 300.0  # The distance cannot be negative... this is really a problem.
     return value
+
+
+def check_distance_batch(values):
+    # vectorized version of check_distance, for a 1d float array
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(values < 0.0, 300.0, values)
@@ -0,0 +1,33 @@
+import sys, argparse
+
+sys.path.append('configuration')
+sys.path.append('input')
+import compiled_dataset
+
+# Decodes and resizes the h5 files of an experiment once, into the memory mappable stores that
+# DatasetManager.read_all_files loads instead of the h5 files, when the config sets compiled_db_path.
+# Run from the root of the repo: python utils/compile_dataset.py -e EXPERIMENT_NAME
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='compile the h5 dataset of an experiment into decoded arrays')
+    parser.add_argument('-e', '--experiment-name', help="the experiment name, in the configuration folder")
+    parser.add_argument('-o', '--output', default=None, help="output folder, defaults to the compiled_db_path of the config")
+    args = parser.parse_args()
+
+    config = __import__(args.experiment_name).configInput()
+    output = args.output
+    if output is None:
+        output = config.compiled_db_path
+
+    all_names = config.sensor_names
+    if hasattr(config, "sensor_augments"):
+        all_names = config.sensor_names + config.sensor_augments
+
+    resize_hw = None
+    if hasattr(config, "hack_resize_image"):
+        resize_hw = config.hack_resize_image
+    faster_aug = hasattr(config, "hack_faster_aug")
+
+    for split, file_names in [("train", config.train_db_path), ("val", config.val_db_path)]:
+        compiled_dataset.compile_dataset(file_names, compiled_dataset.store_path(output, split),
+                                         all_names, config.dataset_names,
+                                         resize_hw=resize_hw, faster_aug=faster_aug)
@@ -0,0 +1,307 @@
+import os, sys, math, argparse, h5py, cv2
+import numpy as np
+from multiprocessing import Pool
+
+# Writes synthetic driving datasets, with the layout of the files of drive_interfaces/carla/carla_recorder.Recorder:
+#   targets: 200*35 float32, the CARLA 0.9.X columns of Recorder._write_to_disk, or 200*100 float32 as written by
+#            utils/compute_waypoints.py: the 35 columns, then 10 ego-centric waypoints (x1, y1, ..., x10, y10) at
+#            35:55, cluster_id at 55, cluster_scale at 56, town_id at 57 and the number of waypoint values at 99
+#   CameraLeft/Middle/Right: vlen uint8, jpeg with quality 80
+#   SegLeft/Middle/Right: vlen uint8, png, the class label in every channel
+# The cars follow a kinematic model along sequences of high level commands, with noise injections as in the data
+# collection, and start on the road of the mapping_helper maps of the towns 10, 11 and 13.
+# Used to run the input pipeline (see benchmark_input.py) and the data tools without the recorded datasets.
+# Run from the root of the repo: python utils/synthetic_h5.py -o OUTPUT_FOLDER -n NUMBER_OF_FILES
+
+ROWS_PER_FILE = 200
+CAMERA_NAMES = ['CameraLeft', 'CameraMiddle', 'CameraRight']
+SEG_NAMES = ['SegLeft', 'SegMiddle', 'SegRight']
+# seconds between two frames
+FRAME_TIME = 0.2
+# the waypoints of compute_waypoints.py, every 0.2s for the next 2s
+NUM_WAYPOINTS = 10
+
+# the map of each town and the inverse of mapping_helper.loc_to_pix: (file, (v scale, v offset), (u scale, u offset))
+TOWN_MAPS = {"10": ("rfs_sim_v1.png", (-3.6103367739019054, 2501.862578166202), (3.6090651558073654, 2500.541076487252)),
+             "11": ("exptown_v1.png", (-6.851075806443265, 2504.8267451634106), (6.848364717542121, 1267.9073339940535)),
+             "13": ("exptown_noshoulder_v1.png", (-6.851075806443265, 2504.8267451634106), (6.848364717542121, 1267.9073339940535))}
+
+# the segmentation classes of CARLA that are drawn, and the bgr color of each in the cameras
+SEG_COLORS = {0: (200, 170, 120),   # sky, as None
+              1: (90, 90, 110),     # buildings
+              6: (220, 220, 220),   # road lines
+              7: (80, 80, 80),      # roads
+              8: (150, 150, 160),   # sidewalks
+              9: (40, 110, 50)}     # vegetation
+# as a cv2.LUT table
+_COLOR_TABLE = np.zeros((1, 256, 3), dtype=np.uint8)
+for _label, _color in SEG_COLORS.items():
+    _COLOR_TABLE[0, _label] = _color
+
+# the high level commands of the planner, and their frequency
+COMMANDS = [2, 3, 4, 5]
+COMMAND_PROBS = [0.55, 0.15, 0.15, 0.15]
+
+_road_pixels = {}
+
+
+def road_pixels(town_id):
+    # the (row, column) of the road pixels of the map of the town, loaded once per process
+    if town_id not in _road_pixels:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_lanes", TOWN_MAPS[town_id][0])
+        im = cv2.imread(path)
+        if im is None:
+            raise IOError("can not read the map " + path)
+        _road_pixels[town_id] = np.argwhere(im.sum(axis=2) > 0)
+    return _road_pixels[town_id]
+
+
+def start_position(town_id, rng):
+    # a random point on the road, in the world coordinates of the town
+    pixels = road_pixels(town_id)
+    v, u = pixels[rng.randint(0, len(pixels))]
+    _, (av, bv), (au, bu) = TOWN_MAPS[town_id]
+    return (v - bv) / av, (u - bu) / au
+
+
+def command_schedule(num_frames, rng):
+    # the high level command of each frame, in segments of 3 to 12 seconds. The file starts with a segment of
+    # each command, in a random order and short enough to fit in the file, so that every control division of the
+    # samplers has frames in any split of the files
+    commands = np.zeros(num_frames, dtype=np.int32)
+    first = list(rng.permutation(COMMANDS))
+    max_first = min(60, num_frames // (len(COMMANDS) + 1))
+    start = 0
+    while start < num_frames:
+        if len(first) > 0:
+            length = rng.randint(15, max_first)
+            command = first.pop(0)
+        else:
+            length = rng.randint(15, 60)
+            command = COMMANDS[rng.choice(len(COMMANDS), p=COMMAND_PROBS)]
+        commands[start:start + length] = command
+        start += length
+    return commands
+
+
+def simulate_drive(num_frames, town_id, rng):
+    # one continuous drive: the expert and the applied (noisy) controls, and the resulting poses
+    commands = command_schedule(num_frames, rng)
+    x, y = start_position(town_id, rng)
+    yaw = rng.uniform(-180, 180)
+    speed = rng.uniform(0, 5)
+    wheelbase = 2.9
+    max_steer_angle = math.radians(35.0)
+
+    out = dict((name, np.zeros(num_frames, dtype=np.float64)) for name in
+               ["steer", "throttle", "brake", "steer_noise", "throttle_noise", "brake_noise",
+                "x", "y", "speed", "acc_x", "acc_y", "yaw"])
+    out["command"] = commands
+    wander = 0.0
+    noise_left = 0
+    noise_value = 0.0
+    for i in range(num_frames):
+        # the expert: a slow wander around the lane center, and a steady steer during the turns
+        wander = 0.9 * wander + rng.normal(0, 0.01)
+        target_speed = {2: 8.0, 3: 4.5, 4: 4.5, 5: 7.0}[commands[i]]
+        steer = wander + {2: 0.0, 3: -0.35, 4: 0.35, 5: 0.0}[commands[i]] * min(speed / 4.5, 1.0)
+        steer = float(np.clip(steer, -0.9, 0.9))
+        accel = 1.5 * (target_speed - speed)
+        throttle = float(np.clip(accel / 3.0, 0.0, 1.0))
+        brake = float(np.clip(-accel / 5.0, 0.0, 1.0))
+
+        # the noise injection of the data collection, a steer pulse of 1 to 3 seconds applied to the car
+        if noise_left == 0 and rng.rand() < 0.01:
+            noise_left = rng.randint(5, 15)
+            noise_value = rng.choice([-1, 1]) * rng.uniform(0.2, 0.4)
+        applied = steer
+        if noise_left > 0:
+            applied = float(np.clip(steer + noise_value, -0.9, 0.9))
+            noise_left -= 1
+
+        out["steer"][i], out["throttle"][i], out["brake"][i] = steer, throttle, brake
+        out["steer_noise"][i], out["throttle_noise"][i], out["brake_noise"][i] = applied, throttle, brake
+        out["x"][i], out["y"][i], out["speed"][i], out["yaw"][i] = x, y, speed, yaw
+
+        # the kinematic bicycle model, with the applied controls
+        new_speed = max(speed + (4.0 * throttle - 8.0 * brake - 0.3) * FRAME_TIME, 0.0)
+        yaw_rate = speed * math.tan(applied * max_steer_angle) / wheelbase
+        out["acc_x"][i] = (new_speed - speed) / FRAME_TIME
+        out["acc_y"][i] = speed * yaw_rate
+        yaw += math.degrees(yaw_rate * FRAME_TIME)
+        yaw = (yaw + 180.0) % 360.0 - 180.0
+        x += speed * math.cos(math.radians(yaw)) * FRAME_TIME
+        y += speed * math.sin(math.radians(yaw)) * FRAME_TIME
+        speed = new_speed
+    return out
+
+
+def ego_waypoints(drive, i, steps):
+    # the positions of the next steps frames, relative to frame i and rotated to its heading,
+    # as compute_waypoints.compute_waypoints
+    delta = np.stack([drive["x"][i + 1:i + 1 + steps] - drive["x"][i],
+                      drive["y"][i + 1:i + 1 + steps] - drive["y"][i]], 1)
+    degree = -math.radians(drive["yaw"][i])
+    R = np.array([[math.cos(degree), -math.sin(degree)], [math.sin(degree), math.cos(degree)]])
+    return np.matmul(R, delta.T).T
+
+
+def targets_matrix(drive, num_rows, num_columns, town_id, start_time_ms):
+    # the targets of the first num_rows frames of the drive, which needs NUM_WAYPOINTS more frames
+    targets = np.zeros((num_rows, num_columns), dtype=np.float32)
+    targets[:, 0] = drive["steer"][:num_rows]
+    targets[:, 1] = drive["throttle"][:num_rows]
+    targets[:, 2] = drive["brake"][:num_rows]
+    targets[:, 5] = drive["steer_noise"][:num_rows]
+    targets[:, 6] = drive["throttle_noise"][:num_rows]
+    targets[:, 7] = drive["brake_noise"][:num_rows]
+    targets[:, 8] = drive["x"][:num_rows]
+    targets[:, 9] = drive["y"][:num_rows]
+    targets[:, 10] = drive["speed"][:num_rows]
+    targets[:, 16] = drive["acc_x"][:num_rows]
+    targets[:, 17] = drive["acc_y"][:num_rows]
+    targets[:, 20] = start_time_ms + np.arange(num_rows) * FRAME_TIME * 1000.0
+    # pitch and roll stay at 0
+    targets[:, 23] = drive["yaw"][:num_rows]
+    targets[:, 24] = drive["command"][:num_rows]
+
+    # the two waypoints 1s and 2s ahead, with their angle and distance, as the 0.8.X recorder
+    for i in range(num_rows):
+        x, y = drive["x"][i], drive["y"][i]
+        yaw = math.radians(drive["yaw"][i])
+        for k, steps in enumerate([5, 10]):
+            wx, wy = drive["x"][i + steps], drive["y"][i + steps]
+            targets[i, 27 + 2 * k] = wx
+            targets[i, 28 + 2 * k] = wy
+            mag = math.hypot(wx - x, wy - y)
+            angle = 0.0
+            if mag > 0:
+                angle = math.atan2(wy - y, wx - x) - yaw
+                angle = (angle + math.pi) % (2 * math.pi) - math.pi
+            targets[i, 31 + 2 * k] = angle
+            targets[i, 32 + 2 * k] = mag
+
+    if num_columns > 35:
+        for i in range(num_rows):
+            targets[i, 35:35 + 2 * NUM_WAYPOINTS] = ego_waypoints(drive, i, NUM_WAYPOINTS).flatten()
+        # a single trajectory cluster, at the unit scale
+        targets[:, 55] = 0
+        targets[:, 56] = 1.0
+        targets[:, 57] = int(town_id)
+        targets[:, 99] = 2 * NUM_WAYPOINTS
+    return targets
+
+
+def render_labels(height, width, steer, lateral, yaw_offset):
+    # a road in perspective, bending with the steer, seen from a camera rotated by yaw_offset (in image widths)
+    horizon = int(height * 0.45)
+    rows = np.arange(height, dtype=np.float32)[:, np.newaxis]
+    cols = np.arange(width, dtype=np.float32)[np.newaxis, :]
+    depth = np.maximum(rows - horizon, 1.0) / (height - horizon)
+    center = width * (0.5 - yaw_offset) + (lateral * depth + steer * 0.6 / depth) * width * 0.5
+    half_width = width * 0.45 * depth
+    offset = np.abs(cols - center)
+
+    labels = np.zeros((height, width), dtype=np.uint8)
+    above = np.broadcast_to(rows < horizon, labels.shape)
+    labels[np.logical_and(above, rows > horizon * 0.6 + 0.2 * horizon * np.sin(cols / width * 7.0))] = 1
+    below = np.logical_not(above)
+    labels[below] = 9
+    labels[np.logical_and(below, offset < half_width * 1.25)] = 8
+    labels[np.logical_and(below, offset < half_width)] = 7
+    # the dashed center line, and the lines at the borders of the road
+    dashes = np.broadcast_to(np.sin(4.0 / depth) > 0, labels.shape)
+    line = np.logical_and(below, np.abs(offset - half_width * 0.95) < half_width * 0.03 + 1)
+    line |= np.logical_and(np.logical_and(below, dashes), offset < half_width * 0.02 + 1)
+    labels[line] = 6
+    return labels
+
+
+def render_frame(height, width, steer, lateral, rng):
+    # the three cameras and their labels, the side cameras are rotated by 30 degrees
+    cameras, segs = [], []
+    for yaw_offset in [-0.4, 0.0, 0.4]:
+        labels = cv2.merge([render_labels(height, width, steer, lateral, yaw_offset)] * 3)
+        image = cv2.LUT(labels, _COLOR_TABLE)
+        # some texture, so that the jpegs have about the size of the recorded ones. The colors are at most 220
+        noise = np.frombuffer(rng.bytes(height * width), dtype=np.uint8).reshape((height, width, 1)) & 15
+        image += noise
+        cameras.append(image)
+        segs.append(labels)
+    return cameras, segs
+
+
+def encode(image, is_label):
+    # the same encodings as Recorder._write_to_disk
+    if is_label:
+        return cv2.imencode(".png", image)[1].flatten()
+    return cv2.imencode(".jpg", image, [int(cv2.IMWRITE_JPEG_QUALITY), 80])[1].flatten()
+
+
+def write_file(path, seed, ifile, resolution=(800, 600), num_columns=100, towns=("10", "11", "13")):
+    # one file, the same for the same (seed, ifile). resolution is (width, height), as the Recorder
+    rng = np.random.RandomState([seed, ifile])
+    town_id = towns[rng.randint(0, len(towns))]
+    drive = simulate_drive(ROWS_PER_FILE + NUM_WAYPOINTS, town_id, rng)
+    width, height = resolution
+
+    hf = h5py.File(path, 'w')
+    hf.create_dataset('targets', data=targets_matrix(drive, ROWS_PER_FILE, num_columns, town_id,
+                                                     rng.uniform(0, 1e6)))
+    dt = h5py.special_dtype(vlen=np.dtype('uint8'))
+    sensors = {}
+    for name in CAMERA_NAMES + SEG_NAMES:
+        sensors[name] = hf.create_dataset(name, (ROWS_PER_FILE,), dtype=dt)
+
+    lateral = 0.0
+    for pos in range(ROWS_PER_FILE):
+        # the drift from the lane center grows with the noisy steer, and comes back with the expert
+        lateral = 0.9 * lateral + 0.5 * (drive["steer_noise"][pos] - drive["steer"][pos])
+        cameras, segs = render_frame(height, width, drive["steer_noise"][pos], lateral, rng)
+        for name, image in zip(CAMERA_NAMES, cameras):
+            sensors[name][pos] = encode(image, False)
+        for name, image in zip(SEG_NAMES, segs):
+            sensors[name][pos] = encode(image, True)
+    hf.close()
+
+
+def _write_file_star(args):
+    return write_file(*args)
+
+
+def write_dataset(output, num_files, seed=0, resolution=(800, 600), num_columns=100, towns=("10", "11", "13"),
+                  first_file=0, num_processes=1):
+    # writes output/data_00000.h5 ... in parallel, each file is a different drive
+    if not os.path.exists(output):
+        os.makedirs(output)
+    jobs = [(os.path.join(output, 'data_' + str(ifile).zfill(5) + '.h5'), seed, ifile, resolution, num_columns, towns)
+            for ifile in range(first_file, first_file + num_files)]
+    if num_processes > 1:
+        pool = Pool(num_processes)
+        pool.map(_write_file_star, jobs)
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            _write_file_star(job)
+    return [job[0] for job in jobs]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='write a synthetic dataset in the format of the carla recorder')
+    parser.add_argument('-o', '--output', help="output folder, the files go to its train and val subfolders")
+    parser.add_argument('-n', '--num-files', type=int, default=10, help="the number of training files")
+    parser.add_argument('-nv', '--num-val-files', type=int, default=2, help="the number of validation files")
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-r', '--resolution', type=int, nargs=2, default=[800, 600], help="width height")
+    parser.add_argument('-c', '--columns', type=int, default=100, choices=[35, 100],
+                        help="35 for the recorder targets, 100 with the waypoints of compute_waypoints.py")
+    parser.add_argument('-t', '--towns', nargs='+', default=["10", "11", "13"], choices=sorted(TOWN_MAPS.keys()))
+    parser.add_argument('-j', '--processes', type=int, default=1)
+    args = parser.parse_args()
+
+    write_dataset(os.path.join(args.output, "train"), args.num_files, args.seed, tuple(args.resolution),
+                  args.columns, tuple(args.towns), num_processes=args.processes)
+    # the validation files continue the numbering of the seeds, so they are different drives
+    write_dataset(os.path.join(args.output, "val"), args.num_val_files, args.seed, tuple(args.resolution),
+                  args.columns, tuple(args.towns), first_file=args.num_files, num_processes=args.processes)